@@ -14,26 +14,56 @@ import socket
 import sys
 import json
 import os
-from docker import Client
+import posixpath
 from mako.template import Template
 from mako.lookup import TemplateLookup
 from controller.AuthController import (AuthController,
                                        require,
                                        member_of,
                                        name_is)
-from controller.DockerController import DockerController
+from controller.DockerController import DockerController, NotPermitted
+from controller.BulkOperations import BulkOperations
+from controller.Admission import AdmissionRejected
 from controller.WebsockifyToken import WebsockifyToken
 from lib.websockify.websocketproxy import WebSocketProxy
+from lib.Services import (getcontainers,
+                          getevents,
+                          getpool,
+                          getjobs,
+                          getcollector,
+                          getactivity,
+                          getidle)
+from lib.JobQueue import JobsBusy
+from lib import ArchiveStream
 
 SESSION_KEY = '_cp_username'
 SESSION_DIR = '/opt/dockerlab/sessions'
+
+# Longest a readiness long poll holds a request thread, in seconds
+
+READY_TIMEOUT = 10.0
+
+# Uploads into containers: the largest accepted, in bytes, how many
+# may run at once, where they go by default and who owns single
+# files uploaded without a tar archive around them. Other request
+# bodies are still limited to FORM_LIMIT.
+
+UPLOAD_LIMIT = 10 * 1024 * 1024 * 1024
+UPLOAD_SLOTS = 4
+UPLOAD_PATH = '/home/user'
+UPLOAD_UID = 1000
+UPLOAD_GID = 1000
+FORM_LIMIT = 100 * 1024 * 1024
+uploads = threading.BoundedSemaphore(UPLOAD_SLOTS)
 lookup = TemplateLookup(directories=['view'])
-cli = Client(base_url='unix://var/run/docker.sock')
-port = 6000
+
+# The activity table is shared with the proxy's handler processes,
+# so it is created here, before the proxy forks any.
 
 websocket_proxy_server = WebSocketProxy(listen_host='',
                                         listen_port='6000',
-                                        token_plugin=WebsockifyToken())
+                                        token_plugin=WebsockifyToken(),
+                                        activity_plugin=getactivity())
 websocket_thread = threading.Thread(target=websocket_proxy_server.start_server,
                                     args=())
 websocket_thread.daemon = True
@@ -54,6 +84,16 @@ def mimetype(type):
     return decorate
 
 
+# Save the session and unlock it before a handler that waits or
+# streams for a long time, so the user's other requests are not
+# blocked behind it. The sessions tool is told it was saved, its own
+# save at the end of the request would fail on the released lock.
+
+def savesession():
+    cherrypy.session.save()
+    cherrypy.serving.request._sessionsaved = True
+
+
 def handle_error():
     tmpl = lookup.get_template('error.html')
     cherrypy.response.status = 500
@@ -72,22 +112,34 @@ class DockerLab(object):
         'tools.proxy.on': True,
         'tools.proxy.local': 'X-Forwarded-Host',
         'tools.proxy.local': 'Host',
+        'request.body.maxbytes': FORM_LIMIT,
         'request.error_response': handle_error
     }
 
     auth = AuthController()
     docker = DockerController()
+    bulkops = BulkOperations(docker)
 
     @cherrypy.expose
     @require()
     def index(self):
         sess = cherrypy.session
         username = cherrypy.session.get(SESSION_KEY)
-        runningimages = self.docker.getrunningcontainers(username)
+
+        # The page only changes when the user's catalog does, so
+        # browsers revalidating an unchanged page get a 304.
+
+        info, etag = self.docker.getcatalog(username)
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = 'private, no-cache'
+        if etag in cherrypy.request.headers.get('If-None-Match', ''):
+            cherrypy.response.status = 304
+            return ''
+        runningimages = info['runningimages']
         runningcount = len(runningimages)
-        baseimages = self.docker.getbaseimages()
+        baseimages = info['baseimages']
         savedcount = len(baseimages)
-        userimages = self.docker.getuserimages(username)
+        userimages = info['userimages']
         savedcount += len(userimages)
         admin = self.auth.isadmin(username)
         tmpl = lookup.get_template('index.html')
@@ -99,23 +151,76 @@ class DockerLab(object):
                            username=username,
                            admin=admin)
 
+    # Run a slow docker operation as a background job. The page
+    # polls the job and moves on to its redirect as soon as it is
+    # done, or shows why it failed.
+
+    def runjob(self, kind, action, func, args, redirect=None):
+        username = cherrypy.session.get(SESSION_KEY)
+        try:
+            jobid = getjobs().submit(username, kind, func, args, redirect)
+        except JobsBusy as e:
+            tmpl = lookup.get_template('redirect.html')
+            return tmpl.render(url='/', wait='4', action=str(e))
+        tmpl = lookup.get_template('job.html')
+        return tmpl.render(action=action, jobid=jobid)
+
+    # State of a job, as JSON. Only visible to its owner.
+
+    @cherrypy.expose
+    @require()
+    @mimetype('application/json')
+    def jobs(self, jobid):
+        username = cherrypy.session.get(SESSION_KEY)
+        job = getjobs().get(jobid)
+        if job is None or job['owner'] != username:
+            raise cherrypy.NotFound()
+        return json.dumps(job)
+
     # Launch a new container
     #
-    # Public port availability gets checked at launch time.
-    # Ports that are already in use get skipped until
-    # the next available port is found. This maintains ligntness
-    # by not managing a port mapping in an unnecessary data structure.
+    # Once the container is started the user waits for its desktop
+    # on the loading page, if no port is left the job fails and
+    # says so.
 
     @cherrypy.expose
     @require()
     def launch(self, container):
-        cid = self.docker.launchcontainer(cherrypy.session.get(SESSION_KEY),
-                                          container)
+        username = cherrypy.session.get(SESSION_KEY)
+        return self.runjob('launch', 'Loading Session.......',
+                           self.docker.launchcontainer,
+                           (username, container),
+                           lambda cid: '/loading/' + str(cid))
+
+    # Wait for a session's desktop, then connect to it
+
+    @cherrypy.expose
+    @require()
+    def loading(self, cid):
         tmpl = lookup.get_template('connect.html')
         return tmpl.render(wait='4',
                            action='Loading Session.......',
-                           cid=str(cid),
-                           password='password')
+                           cid=cid)
+
+    # Long poll for the desktop of a session. Answers as soon as its
+    # VNC server accepts connections, or after timeout seconds. The
+    # session is saved up front so the poll does not hold its lock.
+
+    @cherrypy.expose
+    @require()
+    @mimetype('application/json')
+    def ready(self, cid, timeout='10'):
+        username = cherrypy.session.get(SESSION_KEY)
+        savesession()
+        try:
+            timeout = float(timeout)
+            if timeout != timeout:
+                raise ValueError(timeout)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid timeout')
+        timeout = min(max(timeout, 0), READY_TIMEOUT)
+        ready = self.docker.waitforvnc(username, cid, timeout)
+        return json.dumps({'ready': ready})
 
     # Connect to a container
 
@@ -123,8 +228,16 @@ class DockerLab(object):
     @require()
     def connect(self, cid):
         username = cherrypy.session.get(SESSION_KEY)
-        password = str(os.urandom(32).encode('hex'))[0:32]
-        self.docker.setvncpassword(username, cid, password)
+        try:
+            state = self.docker.wakecontainer(username, cid)
+        except AdmissionRejected as e:
+            tmpl = lookup.get_template('redirect.html')
+            return tmpl.render(url='/', wait='8', action=str(e))
+        if not state:
+            raise cherrypy.NotFound()
+        if state == 'started':
+            raise cherrypy.HTTPRedirect('/loading/' + cid)
+        password = self.docker.getvncpassword(username, cid)
         path = '/getstream/getstream/websockify'
         token = username + ':' + cid
         tmpl = lookup.get_template('vnc.html')
@@ -138,9 +251,9 @@ class DockerLab(object):
     @require()
     def delete(self, cid):
         username = cherrypy.session.get(SESSION_KEY)
-        self.docker.deletecontainer(username, cid)
-        tmpl = lookup.get_template('redirect.html')
-        return tmpl.render(url='/', wait='4', action='Removing Image')
+        return self.runjob('delete', 'Removing Image',
+                           self.docker.deletecontainer,
+                           (username, cid))
 
     # Reboot a container
 
@@ -148,14 +261,14 @@ class DockerLab(object):
     @require()
     def reboot(self, cid):
         username = cherrypy.session.get(SESSION_KEY)
-        self.docker.rebootcontainer(cid)
-        password = str(os.urandom(32).encode('hex'))[0:32]
-        self.docker.setvncpassword(username, cid, password)
+        try:
+            self.docker.rebootcontainer(username, cid)
+        except NotPermitted as e:
+            raise cherrypy.NotFound()
         tmpl = lookup.get_template('connect.html')
         return tmpl.render(wait='4',
                            action='Rebooting Container',
-                           cid=cid,
-                           password=password)
+                           cid=cid)
 
     # End the session but leave the container running
 
@@ -175,16 +288,16 @@ class DockerLab(object):
         tmpl = lookup.get_template('save.html')
         return tmpl.render(cid=cid, name=info['Name'], desc=info['Desc'])
 
-    # Save the container as a new user image
+    # Save the container as a new user image, flattened into a single
+    # layer if squash is set or the image got too deep.
 
     @cherrypy.expose
     @require()
-    def save(self, cid, name, desc):
-        sess = cherrypy.session
+    def save(self, cid, name, desc, squash=''):
         username = cherrypy.session.get(SESSION_KEY)
-        self.docker.saveimage(username, cid, name, desc)
-        tmpl = lookup.get_template('redirect.html')
-        return tmpl.render(url='/', wait='4', action='Saving Container')
+        return self.runjob('save', 'Saving Container',
+                           self.docker.saveimage,
+                           (username, cid, name, desc, bool(squash)))
 
     # Display the metadata form for promoting to base image
     # Requires ADMIN group
@@ -206,9 +319,9 @@ class DockerLab(object):
     @cherrypy.expose
     @require(member_of('admin'))
     def commit(self, repo, reponame, name, desc):
-        self.docker.commitimage(repo, reponame, name, desc)
-        tmpl = lookup.get_template('redirect.html')
-        return tmpl.render(url='/', wait='4', action='Committing Image.')
+        return self.runjob('commit', 'Committing Image.',
+                           self.docker.commitimage,
+                           (repo, reponame, name, desc))
 
     # Removes a running container
 
@@ -216,19 +329,166 @@ class DockerLab(object):
     @require()
     def destroy(self, cid):
         username = cherrypy.session.get(SESSION_KEY)
-        self.docker.destroycontainer(username, cid)
-        tmpl = lookup.get_template('redirect.html')
-        return tmpl.render(url='/', wait='4', action='Destroying Container')
+        return self.runjob('destroy', 'Destroying Container',
+                           self.docker.destroycontainer,
+                           (username, cid))
 
     # Downloads a copy of the running containers /home directory
+    #
+    # The archive is streamed, optionally compressed with
+    # compress='gzip' or 'zstd'. Byte ranges are not offered, the
+    # archive is built from the live /home every time and a range of
+    # it would not match the download it is meant to resume. The
+    # session is saved up front so the stream does not hold its lock.
+
+    @cherrypy.expose
+    @require()
+    def downloadhome(self, cid, compress=''):
+        username = cherrypy.session.get(SESSION_KEY)
+        savesession()
+        if not ArchiveStream.available(compress):
+            raise cherrypy.HTTPError(400, 'Unsupported compression')
+        hometar = self.docker.getcontainerhome(username, cid, compress)
+        if not hometar:
+            raise cherrypy.NotFound()
+        headers = cherrypy.response.headers
+        headers['Content-Disposition'] = hometar['filename']
+        headers['Content-Type'] = hometar['contenttype']
+        headers['Accept-Ranges'] = 'none'
+        return hometar['open']()
+
+    downloadhome._cp_config['response.stream'] = True
+
+    # Upload files into the /home directory of a running container
+    #
+    # GET shows the upload page. A POST or PUT body is either a tar
+    # archive, sent as application/x-tar, or a single file named by
+    # name. It is streamed into the container as it arrives and
+    # never held in full, a body over UPLOAD_LIMIT is cut off with a
+    # 413 and one arriving while UPLOAD_SLOTS uploads are running is
+    # turned away with a 503.
 
     @cherrypy.expose
     @require()
-    @mimetype('application/x-tar')
-    def downloadhome(self, cid):
-        hometar = self.docker.getcontainerhome(cid)
-        cherrypy.response.headers['Content-Disposition'] = hometar['filename']
-        return hometar['data']
+    def upload(self, cid, path=UPLOAD_PATH, name=''):
+        username = cherrypy.session.get(SESSION_KEY)
+        if cherrypy.request.method not in ('POST', 'PUT'):
+            tmpl = lookup.get_template('upload.html')
+            return tmpl.render(cid=cid, path=UPLOAD_PATH)
+        savesession()
+        path = posixpath.normpath(path)
+        if path != '/home' and not path.startswith('/home/'):
+            raise cherrypy.HTTPError(400, 'Uploads go below /home')
+        length = cherrypy.request.headers.get('Content-Length')
+        if length and int(length) > UPLOAD_LIMIT:
+            raise cherrypy.HTTPError(413)
+        reader = ArchiveStream.UploadReader(cherrypy.request.rfile,
+                                            UPLOAD_LIMIT)
+        contenttype = cherrypy.request.headers.get('Content-Type', '')
+        if contenttype.startswith('application/x-tar'):
+            archive = iter(reader)
+        else:
+            name = posixpath.basename(name)
+            if not name or name in ('.', '..'):
+                raise cherrypy.HTTPError(400, 'No file name')
+            if not length:
+                raise cherrypy.HTTPError(411)
+            archive = ArchiveStream.singlefile(name, int(length), reader,
+                                               UPLOAD_UID, UPLOAD_GID)
+        if not uploads.acquire(False):
+            raise cherrypy.HTTPError(503, 'Too many uploads, try again')
+        try:
+            uploaded = self.docker.putcontainerfiles(username, cid, path,
+                                                     archive)
+        except ArchiveStream.ArchiveTooLarge as e:
+            raise cherrypy.HTTPError(413)
+        finally:
+            uploads.release()
+        if not uploaded:
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({'path': path, 'bytes': reader.total})
+
+    upload._cp_config['request.process_request_body'] = False
+
+    # Garbage collection of unreferenced images
+    # Requires ADMIN group
+    #
+    # By default only reports what would be removed, as JSON. With
+    # dryrun=0 the images are removed by a job, whose result is the
+    # report.
+
+    @cherrypy.expose
+    @require(member_of('admin'))
+    def gc(self, dryrun='1'):
+        if dryrun != '0':
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return json.dumps(self.docker.collectimages(True))
+        return self.runjob('gc', 'Removing Unused Images',
+                           self.docker.collectimages, (False,))
+
+    # Bulk operations for a whole class
+    # Requires ADMIN group
+
+    @cherrypy.expose
+    @require(member_of('admin'))
+    def bulk(self):
+        tmpl = lookup.get_template('bulk.html')
+        return tmpl.render(baseimages=self.docker.getbaseimages())
+
+    # Launch an image for every user in usernames, separated by
+    # commas or white space
+
+    @cherrypy.expose
+    @require(member_of('admin'))
+    def bulklaunch(self, image, usernames):
+        names = []
+        for name in usernames.replace(',', ' ').split():
+            if name not in names:
+                names.append(name)
+        return self.runjob('bulk', 'Launching Sessions',
+                           self.bulkops.launch, (image, names),
+                           lambda report: '/bulkreport/' + report['id'])
+
+    @cherrypy.expose
+    @require(member_of('admin'))
+    def bulkdestroy(self, group):
+        return self.runjob('bulk', 'Destroying Sessions',
+                           self.bulkops.destroy, (group,),
+                           lambda report: '/bulkreport/' + report['id'])
+
+    # Save the sessions of a group, or of everyone without one
+
+    @cherrypy.expose
+    @require(member_of('admin'))
+    def bulksave(self, group=''):
+        return self.runjob('bulk', 'Saving Sessions',
+                           self.bulkops.save, (group or None,),
+                           lambda report: '/bulkreport/' + report['id'])
+
+    # Outcome of a bulk operation, as JSON
+
+    @cherrypy.expose
+    @require(member_of('admin'))
+    @mimetype('application/json')
+    def bulkreport(self, reportid):
+        report = self.bulkops.getreport(reportid)
+        if report is None:
+            raise cherrypy.NotFound()
+        return json.dumps(report)
+
+    # Internal statistics, as JSON
+    # Requires ADMIN group
+
+    @cherrypy.expose
+    @require(member_of('admin'))
+    @mimetype('application/json')
+    def stats(self):
+        stats = self.docker.stats()
+        stats['userdb'] = self.auth.stats()
+        stats['jobs'] = getjobs().stats()
+        stats['bulk'] = self.bulkops.stats()
+        return json.dumps(stats)
 
     @cherrypy.expose
     @require(member_of('admin'))
@@ -261,4 +521,41 @@ class DockerLab(object):
         return tmpl.render(url='/', wait='4', action='Changing Password')
 
 
-cherrypy.quickstart(DockerLab())
+dockerlab = DockerLab()
+
+# The container model is created on first use. Make sure that happens
+# in this process before the websocket proxy forks any handlers, so
+# they inherit it instead of each loading their own copy.
+
+cherrypy.engine.subscribe('start', getcontainers)
+
+# Follow docker events to keep cached state current
+
+cherrypy.engine.subscribe('start', getevents().start)
+
+# Keep started containers of the base images ready for launches
+
+cherrypy.engine.subscribe('start', getpool().start)
+
+# Pause and stop idle sessions
+
+cherrypy.engine.subscribe('start', getidle().start)
+
+# Remove unreferenced images on a schedule
+
+cherrypy.engine.subscribe('start', getcollector().start)
+
+# Replace session VNC passwords on a schedule, if configured
+
+cherrypy.engine.subscribe('start', dockerlab.docker.startrotation)
+
+# Pending database writes must reach storage before exit
+
+cherrypy.engine.subscribe('stop', dockerlab.docker.flush)
+cherrypy.engine.subscribe('stop', dockerlab.auth.flush)
+
+# Uploads stream past the server's default body limit, the limit for
+# everything else is FORM_LIMIT.
+
+cherrypy.config.update({'server.max_request_body_size': UPLOAD_LIMIT})
+cherrypy.quickstart(dockerlab)
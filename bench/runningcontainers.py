@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# Benchmark for DockerController.getrunningcontainers
+#
+# Compares listing a user's sessions with one inspect_container call
+# per container against the single label filtered containers() call.
+# The docker daemon is simulated by a client that sleeps for a fixed
+# round trip on every API call, so the result shows the effect of
+# the number of calls rather than of the daemon's own work.
+#
+#   python bench/runningcontainers.py [containers] [round trip ms]
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib import Services
+from model import Storage
+from controller import DockerController
+
+
+class SimulatedDaemon(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.created = {}
+
+    def call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def add(self, username, cid, port):
+        self.created[cid] = {'Id': cid,
+                             'Image': 'dockerlab:bench',
+                             'Names': ['/bench_' + cid[:12]],
+                             'Created': int(time.time()),
+                             'Labels': {DockerController.OWNER_LABEL:
+                                        username,
+                                        DockerController.PORT_LABEL:
+                                        str(port)}}
+
+    # Filters on a label, or on a label's value with label=value
+
+    def containers(self, all=False, filters=None):
+        self.call()
+        label, equals, value = filters['label'].partition('=')
+        return [c for c in self.created.values()
+                if label in c['Labels'] and
+                (not equals or c['Labels'][label] == value)]
+
+    def inspect_container(self, cid):
+        self.call()
+        c = self.created[cid]
+        return {'Config': {'Image': c['Image']},
+                'Name': c['Names'][0],
+                'State': {'StartedAt': '2016-01-01T00:00:00Z'}}
+
+
+# The listing as it was done before labels were applied
+
+def inspecteach(cli, containers, username):
+    runningimages = []
+    for img in containers.getcontainers(username).keys():
+        rinfo = cli.inspect_container(img)
+        runningimages.append({'Image': rinfo['Config']['Image'],
+                              'Name': rinfo['Name'].replace('/', ''),
+                              'Start': rinfo['State']['StartedAt'],
+                              'Cid': img})
+    return runningimages
+
+
+def measure(cli, func, rounds):
+    cli.calls = 0
+    start = time.time()
+    for i in range(rounds):
+        result = func()
+    elapsed = (time.time() - start) / rounds
+    return (len(result), cli.calls // rounds, elapsed)
+
+
+def main():
+    count = 50
+    latency = 2.0
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = float(sys.argv[2])
+    rounds = 5
+
+    Storage.STORAGE = 'journal'
+    Storage.JOURNAL_PATH = tempfile.mkdtemp()
+    cli = SimulatedDaemon(latency / 1000.0)
+    Services.services['client:' + Services.gethost()['name']] = cli
+    containers = Services.getcontainers()
+    for i in range(count):
+        cid = '%064x' % i
+        containers.addcontainer('bench', cid, 6001 + i, 'password',
+                                'dockerlab:bench')
+        cli.add('bench', cid, 6001 + i)
+
+    controller = DockerController.DockerController()
+    for name, func in [('inspect each',
+                        lambda: inspecteach(cli, containers, 'bench')),
+                       ('labelled listing',
+                        lambda: controller.getrunningcontainers('bench'))]:
+        sessions, calls, elapsed = measure(cli, func, rounds)
+        print('%-18s %4d sessions %4d daemon calls %8.1f ms' %
+              (name, sessions, calls, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
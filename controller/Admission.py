@@ -0,0 +1,256 @@
+import threading
+import time
+from lib.JobQueue import RetryLater
+from lib.Services import (getclient,
+                          gethost,
+                          hostnames,
+                          getcontainers,
+                          getpool,
+                          getstate,
+                          getusers,
+                          getjobs)
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+# Resource profiles and admission control for sessions.
+#
+# Every session is created with the memory, CPU and process limits
+# of a profile: the user's entry in USER_PROFILES, else the one of
+# their group in GROUP_PROFILES, else DEFAULT_PROFILE. Swap is
+# limited to the memory limit, so a session that runs out of memory
+# has its processes killed instead of pushing the host into swap.
+#
+# A session is only started on a docker host while the profiles of
+# everything already holding resources there, running or paused
+# sessions, pooled containers and launches under way, still fit it:
+# its memory less HOST_RESERVE bytes for the host itself, and its
+# CPUs times CPU_OVERCOMMIT, CPU time being shared rather than held.
+# A launch that fits no host waits up to ADMISSION_WAIT seconds for
+# capacity to free up, then is rejected with the reason. A launch
+# running as a job does not wait in its worker, which would keep the
+# destroy and save jobs that free capacity from running: the job is
+# put back in the queue and tried again every ADMISSION_INTERVAL
+# seconds, the wait counting from when it was submitted.
+#
+# Of the hosts a session fits on, PLACEMENT picks one:
+# 'least-loaded' the one with the smallest share of its memory
+# committed, 'spread' the one with the fewest sessions and
+# 'binpack' the fullest one, which keeps whole hosts free. Hosts
+# whose daemon cannot be reached are left out.
+
+PROFILES = {
+    'small': {'memory': 1024 * 1024 * 1024, 'cpus': 1.0, 'pids': 256},
+    'default': {'memory': 2048 * 1024 * 1024, 'cpus': 2.0, 'pids': 512},
+    'large': {'memory': 4096 * 1024 * 1024, 'cpus': 4.0, 'pids': 1024},
+}
+DEFAULT_PROFILE = 'default'
+GROUP_PROFILES = {'admin': 'large'}
+USER_PROFILES = {}
+
+HOST_RESERVE = 1024 * 1024 * 1024
+CPU_OVERCOMMIT = 4.0
+ADMISSION_WAIT = 120.0
+ADMISSION_INTERVAL = 2.0
+PLACEMENT = 'least-loaded'
+
+# Container states that hold no memory
+
+STOPPED = set(['created', 'exited', 'dead'])
+
+CPU_PERIOD = 100000
+GB = 1024.0 * 1024 * 1024
+
+
+class AdmissionController(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.hosts = {}
+        self.pending = {}
+        self.tickets = 0
+        self.admitted = 0
+        self.waited = 0
+        self.rejected = 0
+
+    # Profile name of a user
+
+    def profile(self, username):
+        if username in USER_PROFILES:
+            return USER_PROFILES[username]
+        user = getusers().getuser(username)
+        if user and user.get('group') in GROUP_PROFILES:
+            return GROUP_PROFILES[user['group']]
+        return DEFAULT_PROFILE
+
+    # Keyword arguments to create_host_config for a profile
+
+    def limits(self, name):
+        profile = PROFILES[name]
+        limits = {}
+        limits['mem_limit'] = profile['memory']
+        limits['memswap_limit'] = profile['memory']
+        limits['cpu_period'] = CPU_PERIOD
+        limits['cpu_quota'] = int(profile['cpus'] * CPU_PERIOD)
+        limits['pids_limit'] = profile['pids']
+        return limits
+
+    # (memory, cpus) sessions may take on a host, from the daemon's
+    # host information, asked for once. None while the daemon cannot
+    # be reached.
+
+    def capacity(self, host):
+        if host not in self.hosts:
+            try:
+                info = getclient(host).info()
+            except Exception as e:
+                return None
+            self.hosts[host] = (max(info['MemTotal'] - HOST_RESERVE, 0),
+                                info['NCPU'] * CPU_OVERCOMMIT)
+        return self.hosts[host]
+
+    # host -> [memory, cpus, sessions] held by sessions, pooled
+    # containers and the launches admitted but not registered yet.
+    # Sessions the docker state view does not know count as running,
+    # the view only follows the default host. Sessions registered
+    # without a host and the warm pool are on the default host.
+
+    def committed(self):
+        default = gethost()['name']
+        usage = {}
+        for host in hostnames():
+            usage[host] = [0, 0.0, 0]
+
+        def add(host, name, session):
+            entry = usage.setdefault(host, [0, 0.0, 0])
+            entry[0] += PROFILES[name]['memory']
+            entry[1] += PROFILES[name]['cpus']
+            entry[2] += session
+
+        containers = getcontainers()
+        listing = getstate().containers()
+        for username, cid in containers.sessions():
+            container = containers.getcontainer(username, cid)
+            if not container:
+                continue
+            if listing is not None and cid in listing:
+                if listing[cid]['State'] in STOPPED:
+                    continue
+            add(container.get('host') or default,
+                container.get('profile') or DEFAULT_PROFILE, 1)
+        pooled = getpool().stats()['pooled']
+        for i in range(sum(pooled.values())):
+            add(default, DEFAULT_PROFILE, 0)
+        with self.lock:
+            for name, host in self.pending.values():
+                add(host, name, 1)
+        return usage
+
+    # Admit starting a container with a profile on one of hosts, all
+    # of them for None, waiting up to wait seconds for room. Returns
+    # (ticket, host), the ticket holds the resources until it is
+    # released, which is once the container is registered or failed
+    # to start. Raises AdmissionRejected.
+
+    def admit(self, name, wait=ADMISSION_WAIT, hosts=None):
+        if hosts is None:
+            hosts = hostnames()
+        jobs = getjobs()
+        elapsed = jobs.elapsed()
+        deadline = time.time() + wait
+        if elapsed is not None:
+            deadline -= elapsed
+        waiting = False
+        while True:
+            admitted = self.tryadmit(name, hosts)
+            if admitted is not None:
+                return admitted
+            if time.time() + ADMISSION_INTERVAL > deadline:
+                break
+            if elapsed is not None:
+                if not jobs.retries():
+                    self.waited += 1
+                raise RetryLater(ADMISSION_INTERVAL,
+                                 'Waiting for resources to free up')
+            if not waiting:
+                waiting = True
+                self.waited += 1
+            time.sleep(ADMISSION_INTERVAL)
+        self.rejected += 1
+        needs = (PROFILES[name]['memory'] / GB, PROFILES[name]['cpus'])
+        capacity = self.capacity(hosts[0])
+        if len(hosts) > 1 or capacity is None:
+            raise AdmissionRejected(
+                'No docker host has room for the session, it needs %.1f '
+                'GB and %.1f CPUs. Try again later or end an unused '
+                'session.' % needs)
+        used = self.committed()[hosts[0]]
+        raise AdmissionRejected(
+            'The host is at capacity (%.1f of %.1f GB memory and %.1f of '
+            '%.1f CPUs committed), the session needs %.1f GB and %.1f '
+            'CPUs. Try again later or end an unused session.' %
+            ((used[0] / GB, capacity[0] / GB, used[1], capacity[1]) +
+             needs))
+
+    # The committed resources and the new ticket are checked and
+    # taken under the lock, so concurrent launches cannot both take
+    # the last of the capacity.
+
+    def tryadmit(self, name, hosts):
+        profile = PROFILES[name]
+        capacities = {}
+        for host in hosts:
+            capacity = self.capacity(host)
+            if capacity is not None:
+                capacities[host] = capacity
+        with self.lock:
+            usage = self.committed()
+            fits = []
+            for host, capacity in capacities.items():
+                used = usage[host]
+                if (used[0] + profile['memory'] <= capacity[0] and
+                        used[1] + profile['cpus'] <= capacity[1]):
+                    fits.append((placement(used, capacity), host))
+            if not fits:
+                return None
+            host = min(fits)[1]
+            self.tickets += 1
+            self.pending[self.tickets] = (name, host)
+            self.admitted += 1
+            return (self.tickets, host)
+
+    def release(self, ticket):
+        with self.lock:
+            self.pending.pop(ticket, None)
+
+    def stats(self):
+        stats = {}
+        stats['placement'] = PLACEMENT
+        stats['hosts'] = {}
+        for host, used in self.committed().items():
+            hoststats = {}
+            if host in self.hosts:
+                hoststats['capacity_memory'] = self.hosts[host][0]
+                hoststats['capacity_cpus'] = self.hosts[host][1]
+            hoststats['committed_memory'] = used[0]
+            hoststats['committed_cpus'] = used[1]
+            hoststats['sessions'] = used[2]
+            stats['hosts'][host] = hoststats
+        stats['admitted'] = self.admitted
+        stats['waited'] = self.waited
+        stats['rejected'] = self.rejected
+        stats['pending'] = len(self.pending)
+        return stats
+
+
+# Sort key of a host a session fits on, the lowest is picked
+
+def placement(used, capacity):
+    share = float(used[0]) / capacity[0] if capacity[0] else 1.0
+    if PLACEMENT == 'spread':
+        return (used[2], share)
+    if PLACEMENT == 'binpack':
+        return (-share, used[2])
+    return (share, used[2])
@@ -3,11 +3,10 @@ import cherrypy
 from mako.template import Template
 from mako.lookup import TemplateLookup
 import json
-from model.User import User
+from lib.Services import getusers
 
 lookup = TemplateLookup(directories=['view'])
 SESSION_KEY = '_cp_username'
-users = User()
 
 
 def check_auth(*args, **kwargs):
@@ -52,7 +51,7 @@ def require(*conditions):
 def member_of(groupname):
     def check():
         # replace with actual check if <username> is in <groupname>
-        user = users.getuser(cherrypy.request.login)
+        user = getusers().getuser(cherrypy.request.login)
         if user:
             if user['group'] == groupname:
                 return True
@@ -95,12 +94,10 @@ def all_of(*conditions):
 
 class AuthController(object):
 
-    global users
-
     def check_credentials(self, username, password):
         """Verifies credentials for username and password.
         Returns None on success or a string describing the error on failure"""
-        return users.checkuserpass(username, password)
+        return getusers().checkuserpass(username, password)
 
         # An example implementation which uses an ORM could be:
         # u = User.get(username)
@@ -113,7 +110,7 @@ class AuthController(object):
         group = "user"
         if admin:
             group = "admin"
-        return users.adduser(username, password, group, comment)
+        return getusers().adduser(username, password, group, comment)
 
     def on_login(self, username):
         """Called on successful login"""
@@ -122,11 +119,19 @@ class AuthController(object):
         """Called on logout"""
 
     def isadmin(self, username):
-        if users.getuser(username)['group'] == 'admin':
+        if getusers().getuser(username)['group'] == 'admin':
             return True
         else:
             return False
 
+    # Write out pending user database changes, used at shutdown
+
+    def flush(self):
+        return getusers().flush()
+
+    def stats(self):
+        return getusers().stats()
+
     def get_loginform(self,
                       username,
                       msg="Enter login information",
@@ -164,7 +169,7 @@ class AuthController(object):
 
     @cherrypy.expose
     def changepassword(self, username, oldpassword, newpassword):
-        return users.changepassword(username, oldpassword, newpassword)
+        return getusers().changepassword(username, oldpassword, newpassword)
 
     @cherrypy.expose
     def logout(self, from_page="/"):
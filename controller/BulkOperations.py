@@ -0,0 +1,161 @@
+import binascii
+import os
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from lib.Services import getcontainers, getusers, getjobs
+from lib.LRUCache import LRUCache
+
+# Admin operations on many sessions at once, for the start and the
+# end of a class: launch an image for a list of users, destroy the
+# sessions of a group and save the sessions of a group, or of
+# everyone.
+#
+# An operation runs as a single job. The job hands the sessions to
+# up to BULK_WORKERS threads of its own, each taking the next one
+# as soon as it is done with the last, and reports how many are
+# done as it goes. Launches still go through admission, so they
+# start as fast as the hosts have room for them. BULK_WORKERS is
+# kept at the size of a docker client's connection pool, more
+# threads would only wait for a connection.
+#
+# The result of an operation is a report of every session's outcome,
+# how long each took, and the throughput. The last BULK_REPORTS
+# reports are kept to be looked at again.
+
+BULK_WORKERS = 8
+BULK_REPORTS = 20
+
+
+class BulkOperations(object):
+
+    def __init__(self, docker, workers=BULK_WORKERS):
+        self.docker = docker
+        self.workers = workers
+        self.reports = LRUCache(BULK_REPORTS)
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    # Launch image for each of usernames
+
+    def launch(self, image, usernames):
+        return self.run('launch', self.launchone,
+                        [(username, image) for username in usernames])
+
+    def launchone(self, username, image):
+        if not getusers().getuser(username):
+            raise ValueError('No such user ' + username)
+        return self.docker.launchcontainer(username, image)
+
+    # Destroy the sessions of the users in group
+
+    def destroy(self, group):
+        return self.run('destroy', self.docker.destroycontainer,
+                        self.sessions(group))
+
+    # Save the sessions of the users in group, or of all users, under
+    # the name and description of the image they run.
+
+    def save(self, group=None):
+        return self.run('save', self.saveone, self.sessions(group))
+
+    def saveone(self, username, cid):
+        info = self.docker.getimagemetadata(cid)
+        return self.docker.saveimage(username, cid, info['Name'],
+                                     info['Desc'])
+
+    # (username, cid) of the sessions of a group's users, or all
+    # sessions for None
+
+    def sessions(self, group=None):
+        users = getusers()
+        sessions = []
+        for username, cid in getcontainers().sessions():
+            user = users.getuser(username)
+            if group and (not user or user.get('group') != group):
+                continue
+            sessions.append((username, cid))
+        return sessions
+
+    # Run func(username, item) for each (username, item) and return
+    # the report. A call that raises or returns False failed.
+
+    def run(self, kind, func, items):
+        start = time.time()
+        pending = queue.Queue()
+        for index, (username, item) in enumerate(items):
+            pending.put((index, username, item))
+        finished = queue.Queue()
+
+        def worker():
+            while True:
+                try:
+                    index, username, item = pending.get_nowait()
+                except queue.Empty:
+                    return
+                entry = {}
+                entry['user'] = username
+                entry['item'] = item
+                entry['result'] = None
+                entry['error'] = None
+                began = time.time()
+                try:
+                    entry['result'] = func(username, item)
+                    if entry['result'] is False:
+                        entry['error'] = 'No such session'
+                except Exception as e:
+                    entry['error'] = str(e) or e.__class__.__name__
+                entry['state'] = 'failed' if entry['error'] else 'done'
+                entry['seconds'] = time.time() - began
+                finished.put((index, entry))
+
+        for i in range(min(self.workers, len(items))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        jobs = getjobs()
+        results = []
+        for i in range(len(items)):
+            results.append(finished.get())
+            jobs.progress('%d of %d sessions done' % (i + 1, len(items)),
+                          float(i + 1) / len(items))
+        results.sort(key=lambda result: result[0])
+        report = {}
+        report['id'] = binascii.hexlify(os.urandom(8)).decode('ascii')
+        report['kind'] = kind
+        report['workers'] = min(self.workers, len(items))
+        report['items'] = [entry for index, entry in results]
+        report['succeeded'] = len([entry for entry in report['items']
+                                   if entry['state'] == 'done'])
+        report['failed'] = len(items) - report['succeeded']
+        report['seconds'] = time.time() - start
+        report['serial_seconds'] = sum([entry['seconds']
+                                        for entry in report['items']])
+        report['per_minute'] = 0.0
+        if report['seconds'] > 0:
+            report['per_minute'] = 60 * len(items) / report['seconds']
+        self.reports.put(report['id'], report)
+        with self.lock:
+            self.runs += 1
+            self.succeeded += report['succeeded']
+            self.failed += report['failed']
+        return report
+
+    # A recent report by ID, or None
+
+    def getreport(self, reportid):
+        return self.reports.get(reportid)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['workers'] = self.workers
+            stats['runs'] = self.runs
+            stats['succeeded'] = self.succeeded
+            stats['failed'] = self.failed
+            return stats
@@ -1,31 +1,185 @@
-import socket
+import os
 import sys
 import json
-from docker import Client
-from model.Container import Container
-
-cli = Client(base_url='unix://var/run/docker.sock')
-port = 6000
-containers = Container()
+import time
+import socket
+import binascii
+import threading
+from lib.Services import (getclient,
+                          gethost,
+                          hostnames,
+                          getcontainers,
+                          getevents,
+                          getports,
+                          getpool,
+                          getstate,
+                          getjobs,
+                          getcollector,
+                          getactivity,
+                          getidle,
+                          getadmission,
+                          getusers)
+from lib.LRUCache import LRUCache
+from lib.LaunchMetrics import LaunchMetrics
+from lib.CatalogCache import CatalogCache
+from lib.DockerEvents import (eventtype,
+                              eventid,
+                              eventattributes,
+                              eventimage)
+from lib.DockerState import fromlisting, frominspect
+from controller.Admission import DEFAULT_PROFILE
+from lib import ArchiveStream
+
+# Parsed image metadata by image ID. The comment of an image never
+# changes, so entries only leave the cache when it is full.
+
+METADATA_CACHE_SIZE = 1024
+metadata = LRUCache(METADATA_CACHE_SIZE)
+
+# Labels applied to containers at launch. Every container carries
+# the port label, so all of DockerLab's containers can be listed
+# with one filtered call to the daemon, and a user's sessions with
+# one on the owner label. Containers started by the warm pool have
+# no owner label, their owner is only known to the registry.
+
+OWNER_LABEL = 'dockerlab.owner'
+PORT_LABEL = 'dockerlab.port'
+
+# Ports a launch tries before giving up, and the parts of the
+# daemon's error when a start fails because something else holds
+# the port.
+
+LAUNCH_ATTEMPTS = 3
+PORT_TAKEN = ('port is already allocated', 'address already in use')
+
+# A session is ready once its VNC server sends the RFB protocol
+# banner, at the address of the session's docker host. The probe
+# gives up on a single attempt after
+# PROBE_TIMEOUT seconds and retries every PROBE_INTERVAL seconds.
+
+PROBE_TIMEOUT = 1.0
+PROBE_INTERVAL = 0.25
+
+# The VNC password of a session is generated at launch, passed to the
+# container in VNC_PASSWORD_ENV when it is created and applied with
+# vncpasswd once before the session is handed out, for images that
+# do not read the environment. It then stays the same for the life of
+# the session, a connect only reads it from the registry. Every
+# VNC_ROTATE_INTERVAL seconds all sessions get new passwords, 0 turns
+# rotation off.
+
+VNC_PASSWORD_ENV = 'VNC_PASSWORD'
+VNC_ROTATE_INTERVAL = 0
+
+# A saved user image deeper than SQUASH_DEPTH layers is flattened
+# into one, deep chains of layers slow down creating containers and
+# their disk I/O. launches keeps launch times by layer depth.
+
+SQUASH_DEPTH = 20
+launches = LaunchMetrics()
+
+# Images, sessions and the user's saved images shown on the index
+# page, cached per user until something changes them.
+
+catalog = CatalogCache()
+
+
+# Raised when a user asks for something done to a session or image
+# that is not theirs to touch. Run as a job, the job fails with the
+# reason.
+
+class NotPermitted(Exception):
+    pass
 
 
 class DockerController(object):
 
+    # The docker state view subscribes to the events first, so it is
+    # current by the time a catalog invalidated here is rebuilt.
+
+    def __init__(self):
+        self.rotator = None
+        getstate()
+        getevents().subscribe(self.onevent)
+
+    # Everything the index page lists for a user, and its ETag
+
+    def getcatalog(self, username):
+        return catalog.get(username, self.buildcatalog)
+
+    def buildcatalog(self, username):
+        info = {}
+        info['baseimages'] = self.getbaseimages()
+        info['userimages'] = self.getuserimages(username)
+        info['runningimages'] = self.getrunningcontainers(username)
+        return info
+
+    # Invalidate the catalogs showing an image, that is the owner's
+    # for user images and everybody's for base images.
+
+    def invalidateimage(self, repotag):
+        repository = repotag.split(':')[0]
+        if repository.startswith('userimages_'):
+            catalog.invalidate(repository[len('userimages_'):])
+        else:
+            catalog.invalidate()
+
+    # Keeps the catalogs current with changes made outside of
+    # DockerLab. Events caused by writes to the dockerlabconfig
+    # databases and by containers DockerLab does not know about
+    # are ignored.
+
+    def onevent(self, event):
+        image = eventimage(event)
+        if image.startswith('dockerlabconfig'):
+            return
+        if eventtype(event) == 'container':
+            owner = eventattributes(event).get(OWNER_LABEL)
+            if not owner:
+                owner = getcontainers().owner_of(eventid(event))
+            if owner:
+                catalog.invalidate(owner)
+        elif eventtype(event) == 'image':
+            self.invalidateimage(image)
+
     def getrunningcontainers(self, username):
 
         # Running containers are identified by their public port that
         # correlates to their private port 6801. This is enforced as
-        # unique by consequence of socket binding. The public port
+        # unique by the port allocator. The public port
         # number is also used in the path for the websocket as defined
         # in the nginx configuration.
 
+        # Containers come from the docker state view, or from a
+        # single listing of the user's labelled containers while the
+        # view is not synced. Containers claimed from the warm pool,
+        # which have no owner label, those launched before labels
+        # were applied and those on other docker hosts are inspected
+        # one by one if the listing misses them.
+
+        cli = getclient()
+        containers = getcontainers()
+        listing = getstate().containers()
+        if listing is None:
+            listing = {}
+            for rinfo in cli.containers(all=True,
+                                        filters={'label': OWNER_LABEL +
+                                                 '=' + username}):
+                listing[rinfo['Id']] = fromlisting(rinfo)
         runningimages = []
         for img in containers.getcontainers(username).keys():
+            if img in listing:
+                rinfo = listing[img]
+            else:
+                try:
+                    rinfo = frominspect(
+                        clientfor(img).inspect_container(img))
+                except Exception as e:
+                    continue
             active_container = {}
-            rinfo = cli.inspect_container(img)
-            active_container['Image'] = rinfo['Config']['Image']
-            active_container['Name'] = rinfo['Name'].replace('/', '')
-            active_container['Start'] = rinfo['State']['StartedAt']
+            active_container['Image'] = rinfo['Image']
+            active_container['Name'] = rinfo['Name']
+            active_container['Start'] = rinfo['Start']
             active_container['Cid'] = img
             runningimages.append(active_container)
         return runningimages
@@ -44,69 +198,247 @@ class DockerController(object):
 
     # Launch a new container
     #
-    # Public port availability gets checked at launch time.
-    # Ports that are already in use get skipped until
-    # the next available port is found. This maintains ligntness
-    # by not managing a port mapping in an unnecessary data structure.
+    # A started container is taken from the warm pool if there is
+    # one for the image. Otherwise the public port comes from the
+    # port allocator, which knows the ports of every registered
+    # container. A port that turns out to be taken by something
+    # else makes the start fail; it is then left reserved so it is
+    # not handed out again, and the launch is retried on another
+    # port. Any other failure removes the container and gives the
+    # port back. PortsExhausted is raised when no port is left.
+    #
+    # The container gets the limits of the user's resource profile.
+    # Pooled containers have the default profile, so users with
+    # another one always get a new container. A launch has to be
+    # admitted first, it may wait for capacity or fail with
+    # AdmissionRejected. Admission also places it, on one of the
+    # docker hosts that have the image, and the host is recorded in
+    # the registry. Pooled containers are on the default host.
 
     def launchcontainer(self, username, container):
-        global port
-        while testport(port):
-            port += 1
-        container = cli.create_container(image=container,
-                                         ports=[5901],
-                                         host_config=cli.create_host_config(
-                                             port_bindings={5901: port}))
-        response = cli.start(container=container.get('Id'))
-        containers.addcontainer(username,
-                                container.get('Id'),
-                                port,
-                                'password')
-        port += 1
-        return container.get('Id')
+        containers = getcontainers()
+        admission = getadmission()
+        image = container
+        profile = admission.profile(username)
+        pooled = None
+        if profile == DEFAULT_PROFILE:
+            pooled = getpool().claim(image)
+        if pooled:
+            containers.addcontainer(username,
+                                    pooled[0],
+                                    pooled[1],
+                                    pooled[2],
+                                    image,
+                                    profile)
+            getactivity().reset(pooled[1])
+            getstate().refreshcontainer(pooled[0])
+            catalog.invalidate(username)
+            return pooled[0]
+        password = newvncpassword()
+        environment = {VNC_PASSWORD_ENV: password}
+        ticket, host = admission.admit(profile, hosts=imagehosts(image))
+        cli = getclient(host)
+        ports = getports()
+        try:
+            start = time.time()
+            for attempt in range(LAUNCH_ATTEMPTS):
+                port = ports.reserve()
+                cid = None
+                try:
+                    labels = {}
+                    labels[OWNER_LABEL] = username
+                    labels[PORT_LABEL] = str(port)
+                    hostconfig = cli.create_host_config(
+                        port_bindings={5901: port},
+                        **admission.limits(profile))
+                    container = cli.create_container(
+                        image=image,
+                        ports=[5901],
+                        labels=labels,
+                        environment=environment,
+                        host_config=hostconfig)
+                    cid = container.get('Id')
+                    cli.start(container=cid)
+                    break
+                except Exception as e:
+                    if cid:
+                        removecontainer(cli, cid)
+                    if not porttaken(e):
+                        ports.release(port)
+                        raise
+                    if attempt == LAUNCH_ATTEMPTS - 1:
+                        raise
+            elapsed = time.time() - start
+            try:
+                launches.record(imagedepth(cli, image), elapsed)
+            except Exception as e:
+                pass
+            try:
+                applyvncpassword(cid, password, host)
+                containers.addcontainer(username,
+                                        cid,
+                                        port,
+                                        password,
+                                        image,
+                                        profile,
+                                        host)
+            except Exception as e:
+                removecontainer(cli, cid)
+                ports.release(port)
+                raise
+        finally:
+            admission.release(ticket)
+        getactivity().reset(port)
+        getstate().refreshcontainer(cid)
+        catalog.invalidate(username)
+        return cid
+
+    # Unregister a container and give its port back
+
+    def releasecontainer(self, username, cid):
+        containers = getcontainers()
+        container = containers.getcontainer(username, cid)
+        if containers.removecontainer(username, cid):
+            getports().release(container['port'])
 
     # Set VNC password
 
     def setvncpassword(self, username, cid, password):
-        cmdexc = cli.exec_create(container=cid,
-                                 cmd='bash -c \'echo -e "' +
-                                 password +
-                                 '\n' + password + '\n\n"|vncpasswd\'',
-                                 tty=True, user="user")
-        cli.exec_start(cmdexc)
+        containers = getcontainers()
+        applyvncpassword(cid, password, containers.host_of(cid))
         containers.setvncpassword(username, cid, password)
         return True
 
-    # Delete a container
-
-    def deletecontainer(self, username, cid):
-        containers.removecontainer(username, cid)
-        cli.remove_image(cid)
+    # The VNC password of a user's session, as set at launch.
+    # Sessions launched before passwords were set at launch still
+    # carry the placeholder, they get a password on first connect.
+
+    def getvncpassword(self, username, cid):
+        container = getcontainers().getcontainer(username, cid)
+        if not container:
+            return False
+        password = container.get('vnckey')
+        if not password or password == 'password':
+            password = newvncpassword()
+            self.setvncpassword(username, cid, password)
+        return password
+
+    # Replace the VNC passwords of all sessions every
+    # VNC_ROTATE_INTERVAL seconds. A session that fails keeps its
+    # old password until the next round.
+
+    def startrotation(self):
+        if self.rotator is None and VNC_ROTATE_INTERVAL > 0:
+            self.rotator = threading.Thread(target=self.rotatevncpasswords)
+            self.rotator.daemon = True
+            self.rotator.start()
+
+    def rotatevncpasswords(self):
+        while True:
+            time.sleep(VNC_ROTATE_INTERVAL)
+            for username, cid in getcontainers().sessions():
+                try:
+                    self.setvncpassword(username, cid, newvncpassword())
+                except Exception as e:
+                    pass
+
+    # Delete a saved image, one of the user's own or, for admins, a
+    # base image
+    #
+    # Images that still have sessions running from them are kept.
+    # The image is removed from every docker host that has it.
+
+    def deletecontainer(self, username, repotag):
+        repository = repotag.split(':')[0]
+        if repository == 'dockerlab':
+            if not isadmin(username):
+                raise NotPermitted('Only admins can delete base images')
+        elif repository != 'userimages_' + username:
+            raise NotPermitted('Not your image')
+        if getcontainers().containers_for_image(repotag):
+            raise NotPermitted('The image still has sessions running')
+        for host in imagehosts(repotag):
+            getclient(host).remove_image(repotag)
+        self.invalidateimage(repotag)
         return True
 
-    # Reboot a container
-
-    def rebootcontainer(self, cid):
-        return cli.restart(cid)
+    # Wake a user's session that the idle manager paused or stopped.
+    # Returns 'running' if it can be connected to right away and
+    # 'started' if its desktop first has to come up, or False if
+    # there is no such session. Starting a stopped session has to be
+    # admitted like a launch. A session the docker state view
+    # knows to be running costs no call to the daemon.
+
+    def wakecontainer(self, username, cid):
+        if not getcontainers().getcontainer(username, cid):
+            return False
+        listing = getstate().containers()
+        if listing and listing.get(cid, {}).get('State') == 'running':
+            return 'running'
+        return getidle().resume(username, cid)
+
+    # Wait up to timeout seconds for the VNC server of a user's
+    # container to accept connections. Returns True once it does.
+
+    def waitforvnc(self, username, cid, timeout):
+        container = getcontainers().getcontainer(username, cid)
+        if not container:
+            return False
+        deadline = time.time() + timeout
+        while True:
+            if probevnc(gethost(container.get('host'))['address'],
+                        container['port']):
+                return True
+            if time.time() + PROBE_INTERVAL > deadline:
+                return False
+            time.sleep(PROBE_INTERVAL)
+
+    # Reboot a container, only on behalf of its owner
+
+    def rebootcontainer(self, username, cid):
+        if getcontainers().owner_of(cid) != username:
+            raise NotPermitted('Not your session')
+        response = clientfor(cid).restart(cid)
+        catalog.invalidate(username)
+        return response
 
     # get the metadata form for an image
 
     def getimagemetadata(self, cid, sourcename=''):
         if sourcename != '':
-            comment = cli.inspect_image(sourcename)['Comment']
-        else:
-            rinfo = cli.inspect_container(cid)
-            comment = cli.inspect_image(rinfo['Config']['Image'])['Comment']
-        try:
-            info = json.loads(comment)
-        except Exception as e:
-            info = json.loads('{"Name": "Unnamed Image",' +
-                              '"Desc": "Undescribed Image"}')
+            image = getclient(imagehosts(sourcename)[0]).inspect_image(
+                sourcename)
+            return self.getimageinfo(image['Id'], image)
+        host = getcontainers().host_of(cid)
+        rinfo = getclient(host).inspect_container(cid)
+        return self.getimageinfo(rinfo['Image'], host=host)
+
+    # Parsed metadata of an image ID, inspecting the image on host
+    # only if it is not cached yet. Callers that already hold the
+    # result of inspect_image can pass it to save the call.
+
+    def getimageinfo(self, imageid, image=None, host=None):
+        info = metadata.get(imageid)
+        if info is None:
+            if image is None:
+                image = getclient(host).inspect_image(imageid)
+            try:
+                info = json.loads(image['Comment'])
+            except Exception as e:
+                info = json.loads('{"Name": "Unnamed Image",' +
+                                  '"Desc": "Undescribed Image"}')
+            metadata.put(imageid, info)
         return info
 
     # Save the container as a new user image
 
-    def saveimage(self, username, cid, name, desc):
+    def saveimage(self, username, cid, name, desc, squash=False):
+        containers = getcontainers()
+        if containers.owner_of(cid) != username:
+            raise NotPermitted('Not your session')
+        host = containers.host_of(cid)
+        cli = getclient(host)
+        getjobs().progress('Committing changes')
         rinfo = cli.inspect_container(cid)
         if (rinfo['Config']['Image'].split(':')[0] == 'userimages_'+username):
             repository = 'userimages_' + username
@@ -133,64 +465,306 @@ class DockerController(object):
                        tag=tag,
                        message=json.dumps(message))
 
-        containers.removecontainer(username, cid)
+        self.releasecontainer(username, cid)
         cli.remove_container(container=cid, force=True)
+        repotag = repository + ':' + tag
+        if squash or imagedepth(cli, repotag) > SQUASH_DEPTH:
+            squashimage(cli, repotag, json.dumps(message))
+        getstate().loadimages()
+        catalog.invalidate(username)
         return True
 
-    # tags an image as a base image
+    # tags an image as a base image, on every docker host that has it
     # requires ADMIN group
 
     def commitimage(self, repo, reponame, name, desc):
-        cli.tag(image=repo, repository="dockerlab", tag=reponame, force=True)
+        for host in imagehosts(repo):
+            getclient(host).tag(image=repo,
+                                repository="dockerlab",
+                                tag=reponame,
+                                force=True)
+        getstate().loadimages()
+        catalog.invalidate()
         return True
 
-    # Removes a running container
+    # Removes a running container, only on behalf of its owner
 
     def destroycontainer(self, username, cid):
-        cli.remove_container(container=cid, force=True)
-        containers.removecontainer(username, cid)
+        containers = getcontainers()
+        if containers.owner_of(cid) != username:
+            raise NotPermitted('Not your session')
+        clientfor(cid).remove_container(container=cid, force=True)
+        self.releasecontainer(username, cid)
+        catalog.invalidate(username)
         return True
 
-    # gets a copy of the running containers /home directory
+    # Remove images nothing refers to, or with dryrun only report
+    # them.
+
+    def collectimages(self, dryrun=False):
+        return getcollector().collect(dryrun)
+
+    # Write out pending container database changes, used at shutdown
+
+    def flush(self):
+        return getcontainers().flush()
+
+    # Statistics for the container database, the caches and the
+    # calls to the daemon
+
+    def stats(self):
+        stats = {}
+        stats['containerdb'] = getcontainers().stats()
+        stats['metadata'] = metadata.stats()
+        stats['catalog'] = catalog.stats()
+        stats['ports'] = getports().stats()
+        stats['pool'] = getpool().stats()
+        stats['events'] = getevents().stats()
+        stats['client'] = dict([(host, getclient(host).stats())
+                                for host in hostnames()])
+        stats['state'] = getstate().stats()
+        stats['launches'] = launches.stats()
+        stats['gc'] = getcollector().stats()
+        stats['idle'] = getidle().stats()
+        stats['admission'] = getadmission().stats()
+        return stats
 
-    def getcontainerhome(self, cid):
+    # gets a copy of the running containers /home directory
+    #
+    # Only for the container's owner. The archive is not read here,
+    # 'open' starts a new stream of its chunks, compressed with
+    # encoding, every time it is called.
+
+    def getcontainerhome(self, username, cid, encoding=''):
+        if getcontainers().owner_of(cid) != username:
+            return False
+        cli = clientfor(cid)
         rinfo = cli.inspect_container(cid)
         name = rinfo['Name'].replace('/', '')
+        extension, contenttype = ArchiveStream.ENCODINGS[encoding]
+
+        def openstream():
+            if hasattr(cli, 'get_archive'):
+                data = cli.get_archive(container=cid, path='/home')[0]
+            else:
+                data = cli.copy(container=cid, resource='/home')
+            return ArchiveStream.compressed(ArchiveStream.readchunks(data),
+                                            encoding)
+
         hometar = {}
-        hometar['filename'] = 'attachment; filename="' + name + '_homedir.tar"'
-        hometar['data'] = cli.copy(container=cid, resource='/home')
+        hometar['filename'] = ('attachment; filename="' + name +
+                               '_homedir' + extension + '"')
+        hometar['contenttype'] = contenttype
+        hometar['open'] = openstream
         return hometar
 
+    # Unpack a tar archive, given as a stream of chunks, at path in a
+    # container. Only for the container's owner. The archive is sent
+    # as it is read, so the daemon sets the pace of the upload.
+
+    def putcontainerfiles(self, username, cid, path, chunks):
+        if getcontainers().owner_of(cid) != username:
+            return False
+        return clientfor(cid).put_archive(container=cid, path=path,
+                                          data=chunks)
+
     # Used to get images using repository name
     # Base image metadata is stored in the comment
     # field of the image in JSON.  If the metadata is absent
-    # defaults are assumed for display.
+    # defaults are assumed for display. Once the metadata of
+    # every image is cached the images come from the docker state
+    # view, or from a single call to docker while it is not synced.
+    # Images on the other docker hosts are listed from each of them,
+    # an image on several hosts is shown once.
 
     def getimagesbyrepo(self, repository):
         storedImages = []
-        images = cli.images(repository)
-        for img in images:
-            try:
-                info = json.loads(cli.inspect_image(img['Id'])['Comment'])
-            except Exception as e:
-                info = json.loads('{"Name": "Unnamed Image",' +
-                                  '"Desc": "Undescribed Image"}')
+        default = gethost()['name']
+        images = []
+        for host in hostnames():
+            listing = None
+            if host == default:
+                listing = getstate().imagesbyrepo(repository)
+            if listing is None:
+                listing = [(img['RepoTags'][0], img['Id'])
+                           for img in getclient(host).images(repository)]
+            images.extend([(repotag, imageid, host)
+                           for repotag, imageid in listing])
+        shown = set()
+        for repotag, imageid, host in images:
+            if repotag in shown:
+                continue
+            shown.add(repotag)
+            info = self.getimageinfo(imageid, host=host)
             imagedef = {}
-            imagedef['RepoTag'] = img['RepoTags'][0]
+            imagedef['RepoTag'] = repotag
             imagedef['Name'] = info['Name']
             imagedef['Desc'] = info['Desc']
             storedImages.append(imagedef)
         return storedImages
 
 
-# Used to confirm the availability of a local port
+# True if a start failed because something else holds the port
+
+def porttaken(error):
+    message = str(error)
+    return any([taken in message for taken in PORT_TAKEN])
+
+
+# Whether a user is in the admin group
+
+def isadmin(username):
+    user = getusers().getuser(username)
+    return bool(user) and user.get('group') == 'admin'
+
 
-def testport(portnum):
+# Remove a container that failed to become a session, leaving the
+# error that got it there to the caller.
+
+def removecontainer(cli, cid):
+    try:
+        cli.remove_container(container=cid, force=True)
+    except Exception as e:
+        pass
+
+
+# Client of the docker host a registered container runs on
+
+def clientfor(cid):
+    return getclient(getcontainers().host_of(cid))
+
+
+# Names of the docker hosts that have an image. With a single host
+# the daemon is not asked. If no host has it, the default host is
+# returned so the caller gets the daemon's error.
+
+def imagehosts(image):
+    names = hostnames()
+    if len(names) == 1:
+        return names
+    found = []
+    for host in names:
+        try:
+            getclient(host).inspect_image(image)
+            found.append(host)
+        except Exception as e:
+            pass
+    return found or names[:1]
+
+
+# Number of file system layers of an image
+
+def imagedepth(cli, image):
+    rinfo = cli.inspect_image(image)
+    if 'RootFS' in rinfo:
+        return len(rinfo['RootFS'].get('Layers') or [])
+    return len(cli.history(image))
+
+
+# Flatten an image into a single layer
+#
+# The file system of a container created from the image is exported
+# and imported again under the same tag, with the image's
+# configuration carried over. Import takes no comment, so the
+# metadata is committed on top as an empty layer. The layered image
+# is removed unless sessions still run from it. Used for saves and
+# by the image collector.
+
+def squashimage(cli, repotag, message):
+    jobs = getjobs()
+    repository, tag = repotag.rsplit(':', 1)
+    layered = cli.inspect_image(repotag)
+    jobs.progress('Flattening image layers', 0.25)
+    flat = cli.create_container(image=repotag)
+    try:
+        cli.import_image_from_stream(cli.export(flat.get('Id')),
+                                     repository=repository,
+                                     tag=tag,
+                                     changes=configchanges(
+                                         layered['Config']))
+    finally:
+        cli.remove_container(container=flat.get('Id'), force=True)
+    jobs.progress('Restoring image metadata', 0.75)
+    described = cli.create_container(image=repotag)
+    try:
+        cli.commit(container=described.get('Id'),
+                   repository=repository,
+                   tag=tag,
+                   message=message)
+    finally:
+        cli.remove_container(container=described.get('Id'), force=True)
+    try:
+        cli.remove_image(layered['Id'])
+    except Exception as e:
+        pass
+
+
+# Dockerfile instructions restoring an image configuration, used when
+# an image is imported from a flat file system.
+
+def configchanges(config):
+    changes = []
+    for variable in config.get('Env') or []:
+        name, _, value = variable.partition('=')
+        changes.append('ENV ' + name + '=' + json.dumps(value))
+    for port in (config.get('ExposedPorts') or {}).keys():
+        changes.append('EXPOSE ' + port)
+    for name, value in (config.get('Labels') or {}).items():
+        changes.append('LABEL ' + json.dumps(name) + '=' + json.dumps(value))
+    if config.get('User'):
+        changes.append('USER ' + config['User'])
+    if config.get('WorkingDir'):
+        changes.append('WORKDIR ' + config['WorkingDir'])
+    if config.get('Entrypoint'):
+        changes.append('ENTRYPOINT ' + json.dumps(config['Entrypoint']))
+    if config.get('Cmd'):
+        changes.append('CMD ' + json.dumps(config['Cmd']))
+    return changes
+
+
+# A new random VNC password
+
+def newvncpassword():
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+# Run vncpasswd in a container on host, without touching the
+# registry
+
+def applyvncpassword(cid, password, host=None):
+    cli = getclient(host)
+    cmdexc = cli.exec_create(container=cid,
+                             cmd='bash -c \'echo -e "' +
+                             password +
+                             '\n' + password + '\n\n"|vncpasswd\'',
+                             tty=True, user="user")
+    cli.exec_start(cmdexc)
+
+
+# The VNC password a container was created with, from the result of
+# inspect_container, or None.
+
+def envpassword(rinfo):
+    for variable in rinfo['Config'].get('Env') or []:
+        name, _, value = variable.partition('=')
+        if name == VNC_PASSWORD_ENV:
+            return value
+    return None
+
+
+# True if an RFB server is answering on host:port. Docker's port
+# proxy accepts connections before the container listens, so a
+# connection alone does not count, the server has to send its
+# protocol version.
+
+def probevnc(host, port):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(PROBE_TIMEOUT)
     try:
-        s.bind(('0.0.0.0', port))
-    except socket.error as e:
+        s.connect((host, port))
+        banner = s.recv(12)
+    except (socket.error, socket.timeout) as e:
+        return False
+    finally:
         s.close()
-        return True
-    s.close()
-    return False
+    return banner.startswith(b'RFB ')
@@ -0,0 +1,149 @@
+import threading
+import time
+from lib.Services import (getclient,
+                          gethost,
+                          getcontainers,
+                          getactivity,
+                          getstate,
+                          getadmission)
+from controller.Admission import DEFAULT_PROFILE
+
+# Idle session tiering.
+#
+# Sessions without input from a viewer are paused after PAUSE_AFTER
+# seconds, which frees their CPU, and stopped after STOP_AFTER
+# seconds, which frees their memory too. They stay registered and
+# keep their port, connect wakes them up again. Input comes from the
+# proxy's activity table, the update requests a viewer sends by
+# itself do not count, so a desktop left open in a forgotten browser
+# tab is still stopped. A session with a connection open is never
+# paused though, so nobody's screen freezes in front of them.
+# Sessions on ports the activity table has no slot for, from before
+# the port range, have no known input and are left alone.
+#
+# Sessions are checked every IDLE_CHECK seconds. PAUSE_AFTER or
+# STOP_AFTER of 0 turns that tier off.
+
+PAUSE_AFTER = 15 * 60
+STOP_AFTER = 2 * 60 * 60
+IDLE_CHECK = 60.0
+
+
+class IdleManager(object):
+
+    def __init__(self, pauseafter=PAUSE_AFTER, stopafter=STOP_AFTER):
+        self.pauseafter = pauseafter
+        self.stopafter = stopafter
+        self.lock = threading.Lock()
+        self.thread = None
+        self.started = time.time()
+        self.pauses = 0
+        self.stops = 0
+        self.resumes = 0
+        self.errors = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None and (self.pauseafter or self.stopafter):
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(IDLE_CHECK)
+            try:
+                self.check()
+            except Exception as e:
+                self.errors += 1
+
+    # (seconds since a session's last input, open connections).
+    # Input from before DockerLab started is unknown, so that counts
+    # as the last input.
+
+    def idlefor(self, port):
+        total, lastframe, lastinput, connections = getactivity().get(port)
+        return (time.time() - max(lastinput, self.started), connections)
+
+    def check(self):
+        containers = getcontainers()
+        activity = getactivity()
+        listing = getstate().containers()
+        for username, cid in containers.sessions():
+            container = containers.getcontainer(username, cid)
+            if not container or not activity.tracks(container['port']):
+                continue
+            idle, connections = self.idlefor(container['port'])
+            if idle < min([after for after in (self.pauseafter,
+                                               self.stopafter) if after]):
+                continue
+            try:
+                cli = getclient(container.get('host'))
+                state = None
+                if listing is not None and cid in listing:
+                    state = listing[cid]['State']
+                if not state:
+                    state = containerstate(cli.inspect_container(cid))
+                if (self.stopafter and idle >= self.stopafter and
+                        state in ('running', 'paused')):
+                    if state == 'paused':
+                        cli.unpause(cid)
+                    cli.stop(cid)
+                    self.stops += 1
+                elif (self.pauseafter and idle >= self.pauseafter and
+                        not connections and state == 'running'):
+                    cli.pause(cid)
+                    self.pauses += 1
+            except Exception as e:
+                self.errors += 1
+
+    # Bring a paused or stopped session back. Returns 'running' if it
+    # was running already or has been unpaused, and 'started' if it
+    # had to be started again, its desktop then still has to come
+    # up. A start is admitted without waiting, AdmissionRejected is
+    # raised if the session's host has no room for it.
+
+    def resume(self, username, cid):
+        container = getcontainers().getcontainer(username, cid)
+        host = gethost(container.get('host'))['name']
+        cli = getclient(host)
+        state = containerstate(cli.inspect_container(cid))
+        if state == 'paused':
+            cli.unpause(cid)
+            self.resumes += 1
+        elif state != 'running':
+            admission = getadmission()
+            ticket, host = admission.admit(container.get('profile') or
+                                           DEFAULT_PROFILE, 0, [host])
+            try:
+                cli.start(cid)
+            finally:
+                admission.release(ticket)
+            self.resumes += 1
+            return 'started'
+        return 'running'
+
+    def stats(self):
+        stats = {}
+        stats['pause_after'] = self.pauseafter
+        stats['stop_after'] = self.stopafter
+        stats['pauses'] = self.pauses
+        stats['stops'] = self.stops
+        stats['resumes'] = self.resumes
+        stats['errors'] = self.errors
+        stats['activity'] = getactivity().stats()
+        return stats
+
+
+# State of a container from inspect_container. Older daemons have no
+# Status, only the flags.
+
+def containerstate(rinfo):
+    state = rinfo['State']
+    if 'Status' in state:
+        return state['Status']
+    if state.get('Paused'):
+        return 'paused'
+    if state.get('Running'):
+        return 'running'
+    return 'exited'
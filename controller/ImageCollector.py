@@ -0,0 +1,153 @@
+import threading
+import time
+from lib.Services import getclient
+
+# Garbage collection of images nothing refers to any more.
+#
+# An image is kept if it is tagged, used by a container, running or
+# not, or an ancestor of either; everything else is garbage.
+#
+# A dockerlabconfig database is committed on top of the same null
+# image every time, so its old versions drop out by themselves. A
+# save of a session started from a user image commits on top of
+# that image, the old version stays the new one's parent and is
+# kept until a save deeper than SQUASH_DEPTH flattens the image.
+#
+# Removing an unreachable image also removes its unreachable
+# parents, so only the unreachable images without unreachable
+# children are removed, GC_BATCH at a time with GC_PAUSE seconds in
+# between to leave the daemon to other callers.
+#
+# Only untagged images are ever removed, so images of other
+# repositories on the host are left alone.
+#
+# The collector runs every GC_INTERVAL seconds, 0 turns the schedule
+# off. A dry run reports what would be removed without removing it.
+
+GC_INTERVAL = 6 * 60 * 60
+GC_BATCH = 50
+GC_PAUSE = 1.0
+
+
+class ImageCollector(object):
+
+    def __init__(self, interval=GC_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.runs = 0
+        self.removed = 0
+        self.reclaimed = 0
+        self.errors = 0
+        self.lastrun = None
+        self.lastreport = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None and self.interval > 0:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.collect()
+            except Exception as e:
+                self.errors += 1
+
+    # Images by ID and the IDs of the reachable ones
+
+    def reachable(self):
+        cli = getclient()
+        images = {}
+        for img in cli.images(all=True):
+            images[img['Id']] = img
+        roots = set()
+        for img in images.values():
+            if [tag for tag in img.get('RepoTags') or []
+                    if tag != '<none>:<none>']:
+                roots.add(img['Id'])
+        for rinfo in cli.containers(all=True):
+            if rinfo.get('ImageID'):
+                roots.add(rinfo['ImageID'])
+            else:
+                roots.add(cli.inspect_container(rinfo['Id'])['Image'])
+        reachable = set()
+        for imageid in roots:
+            while imageid and imageid not in reachable:
+                reachable.add(imageid)
+                imageid = images.get(imageid, {}).get('ParentId')
+        return images, reachable
+
+    # Collect the garbage, or with dryrun only report it. Returns the
+    # report, which is also kept for the statistics.
+
+    def collect(self, dryrun=False):
+        cli = getclient()
+        start = time.time()
+        images, reachable = self.reachable()
+        garbage = set([imageid for imageid in images
+                       if imageid not in reachable])
+        parents = set([images[imageid].get('ParentId')
+                       for imageid in garbage])
+        leaves = [imageid for imageid in garbage if imageid not in parents]
+        report = {}
+        report['dryrun'] = dryrun
+        report['images'] = len(images)
+        report['reachable'] = len(reachable)
+        report['unreachable'] = len(garbage)
+        report['candidates'] = sorted(leaves)
+        report['estimated_bytes'] = sum([ownsize(images, imageid)
+                                         for imageid in garbage])
+        report['removed'] = 0
+        report['reclaimed_bytes'] = 0
+        report['errors'] = 0
+        if not dryrun:
+            for index, imageid in enumerate(leaves):
+                if index and index % GC_BATCH == 0:
+                    time.sleep(GC_PAUSE)
+                try:
+                    cli.remove_image(imageid)
+                except Exception as e:
+                    report['errors'] += 1
+            remaining = set([img['Id'] for img in cli.images(all=True)])
+            gone = [imageid for imageid in garbage
+                    if imageid not in remaining]
+            report['removed'] = len(gone)
+            report['reclaimed_bytes'] = sum([ownsize(images, imageid)
+                                             for imageid in gone])
+        report['seconds'] = time.time() - start
+        with self.lock:
+            self.runs += 1
+            self.removed += report['removed']
+            self.reclaimed += report['reclaimed_bytes']
+            self.errors += report['errors']
+            self.lastrun = start
+            self.lastreport = dict(report)
+            del self.lastreport['candidates']
+        return report
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['interval'] = self.interval
+            stats['runs'] = self.runs
+            stats['removed'] = self.removed
+            stats['reclaimed_bytes'] = self.reclaimed
+            stats['errors'] = self.errors
+            stats['last_run'] = self.lastrun
+            stats['last_report'] = self.lastreport
+            return stats
+
+
+# Bytes an image adds on top of its parent. The listing gives the
+# size of an image including all of its parents.
+
+def ownsize(images, imageid):
+    img = images[imageid]
+    parent = images.get(img.get('ParentId'))
+    if parent:
+        return max(img.get('Size', 0) - parent.get('Size', 0), 0)
+    return img.get('Size', 0)
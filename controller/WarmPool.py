@@ -0,0 +1,263 @@
+import threading
+import time
+from lib.Services import (getclient,
+                          gethost,
+                          getcontainers,
+                          getports,
+                          getadmission)
+from controller.Admission import DEFAULT_PROFILE, AdmissionRejected
+from controller.DockerController import (PORT_LABEL,
+                                         VNC_PASSWORD_ENV,
+                                         newvncpassword,
+                                         applyvncpassword,
+                                         envpassword,
+                                         porttaken,
+                                         removecontainer)
+
+# Warm pool of started containers for the base images.
+#
+# For every image in the POOL_REPOSITORY repository POOL_SIZE
+# containers are kept started and waiting, so a launch only has to
+# hand one of them to the user. A background thread refills a pool
+# as soon as a container is claimed from it, and every
+# REFILL_INTERVAL seconds picks up new base images, drops pools of
+# removed ones and replaces pooled containers that died.
+#
+# Pooled containers carry POOL_LABEL with the image they were
+# started from. Those still waiting when DockerLab stops are taken
+# over again on the next start. Pooled containers have the limits of
+# the default resource profile and run on the default docker host,
+# the pool is only refilled while it has room for them. Each gets
+# its VNC password when it is started, so a claim hands out a
+# session that is ready to connect; adopted containers have theirs
+# read back from their environment.
+
+POOL_SIZE = 2
+POOL_REPOSITORY = 'dockerlab'
+POOL_LABEL = 'dockerlab.pool'
+REFILL_INTERVAL = 60.0
+
+# An image whose containers fail to start is left alone for
+# FAILURE_BACKOFF seconds, twice as long after every further
+# failure, up to MAX_BACKOFF seconds.
+
+FAILURE_BACKOFF = 60.0
+MAX_BACKOFF = 3600.0
+
+
+class WarmPool(object):
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pools = {}
+        self.failures = {}
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.errors = 0
+        self.lastrefill = 0.0
+        self.maxrefill = 0.0
+        self.totalrefill = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None and self.size > 0:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    # Take a started container of an image out of the pool. Returns
+    # (cid, port, password), or None if the pool of the image is empty.
+
+    def claim(self, image):
+        with self.lock:
+            pool = self.pools.get(image)
+            if pool:
+                self.hits += 1
+                entry = pool.pop(0)
+            else:
+                self.misses += 1
+                entry = None
+        self.wakeup.set()
+        return entry
+
+    # Pooled containers of a previous run are adopted before the
+    # first refill, retried every interval while the daemon fails
+    # to answer.
+
+    def run(self):
+        adopted = False
+        while True:
+            try:
+                if not adopted:
+                    self.adopt()
+                    adopted = True
+                self.reconcile()
+                self.refill()
+            except Exception as e:
+                self.errors += 1
+            self.wakeup.wait(REFILL_INTERVAL)
+            self.wakeup.clear()
+
+    # Take over pooled containers left by a previous run
+
+    def adopt(self):
+        cli = getclient()
+        for rinfo in cli.containers(all=True,
+                                    filters={'label': POOL_LABEL}):
+            labels = rinfo.get('Labels') or {}
+            image = labels.get(POOL_LABEL)
+            port = int(labels.get(PORT_LABEL, 0))
+            if getcontainers().owner_of(rinfo['Id']):
+                continue
+            if not isrunning(rinfo):
+                cli.remove_container(container=rinfo['Id'], force=True)
+                continue
+            password = envpassword(cli.inspect_container(rinfo['Id']))
+            if not password:
+                password = newvncpassword()
+                applyvncpassword(rinfo['Id'], password)
+            getports().claim(port)
+            with self.lock:
+                self.pools.setdefault(image, []).append(
+                    (rinfo['Id'], port, password))
+
+    # Match the pools to the current base images and running
+    # containers.
+
+    def reconcile(self):
+        cli = getclient()
+        images = set()
+        for img in cli.images(POOL_REPOSITORY):
+            images.update([tag for tag in img['RepoTags']
+                           if tag.startswith(POOL_REPOSITORY + ':')])
+        running = set([rinfo['Id'] for rinfo
+                       in cli.containers(filters={'label': POOL_LABEL})])
+        stale = []
+        with self.lock:
+            for image in list(self.pools.keys()):
+                keep = []
+                for entry in self.pools[image]:
+                    if image in images and entry[0] in running:
+                        keep.append(entry)
+                    else:
+                        stale.append(entry)
+                self.pools[image] = keep
+                if image not in images:
+                    del self.pools[image]
+            for image in images:
+                self.pools.setdefault(image, [])
+            for image in list(self.failures.keys()):
+                if image not in images:
+                    del self.failures[image]
+        for entry in stale:
+            self.discard(entry[0], entry[1])
+
+    def discard(self, cid, port):
+        try:
+            getclient().remove_container(container=cid, force=True)
+        except Exception as e:
+            pass
+        getports().release(port)
+
+    def refill(self):
+        with self.lock:
+            missing = [(image, self.size - len(pool))
+                       for image, pool in self.pools.items()
+                       if len(pool) < self.size]
+        admission = getadmission()
+        for image, count in missing:
+            failures, retryat = self.failures.get(image, (0, 0))
+            if retryat > time.time():
+                continue
+            for i in range(count):
+                try:
+                    ticket, host = admission.admit(DEFAULT_PROFILE, 0,
+                                                   [gethost()['name']])
+                except AdmissionRejected as e:
+                    return
+                start = time.time()
+                try:
+                    entry = self.startcontainer(image)
+                except Exception as e:
+                    self.errors += 1
+                    failures += 1
+                    backoff = min(FAILURE_BACKOFF * 2 ** (failures - 1),
+                                  MAX_BACKOFF)
+                    self.failures[image] = (failures, time.time() + backoff)
+                    break
+                finally:
+                    admission.release(ticket)
+                self.failures.pop(image, None)
+                latency = time.time() - start
+                with self.lock:
+                    if image not in self.pools:
+                        self.pools[image] = []
+                    self.pools[image].append(entry)
+                    self.refills += 1
+                    self.lastrefill = latency
+                    self.maxrefill = max(self.maxrefill, latency)
+                    self.totalrefill += latency
+
+    # A port that something else holds is left reserved, the same
+    # as for a launch, any other failure gives the port back.
+
+    def startcontainer(self, image):
+        cli = getclient()
+        ports = getports()
+        port = ports.reserve()
+        password = newvncpassword()
+        cid = None
+        try:
+            labels = {}
+            labels[PORT_LABEL] = str(port)
+            labels[POOL_LABEL] = image
+            hostconfig = cli.create_host_config(
+                port_bindings={5901: port},
+                **getadmission().limits(DEFAULT_PROFILE))
+            container = cli.create_container(image=image,
+                                             ports=[5901],
+                                             labels=labels,
+                                             environment={VNC_PASSWORD_ENV:
+                                                          password},
+                                             host_config=hostconfig)
+            cid = container.get('Id')
+            cli.start(container=cid)
+            applyvncpassword(cid, password)
+        except Exception as e:
+            if cid:
+                removecontainer(cli, cid)
+            if not porttaken(e):
+                ports.release(port)
+            raise
+        return (cid, port, password)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['size'] = self.size
+            stats['hits'] = self.hits
+            stats['misses'] = self.misses
+            stats['refills'] = self.refills
+            stats['errors'] = self.errors
+            stats['failing'] = sorted(self.failures.keys())
+            stats['last_refill'] = self.lastrefill
+            stats['max_refill'] = self.maxrefill
+            if self.refills:
+                stats['avg_refill'] = self.totalrefill / self.refills
+            else:
+                stats['avg_refill'] = 0.0
+            stats['pooled'] = dict([(image, len(pool))
+                                    for image, pool in self.pools.items()])
+            return stats
+
+
+# Older daemons only report the state in the Status text
+
+def isrunning(rinfo):
+    if 'State' in rinfo:
+        return rinfo['State'] == 'running'
+    return rinfo.get('Status', '').startswith('Up')
@@ -1,19 +1,24 @@
 import os
-from model.Container import Container
+from lib.Services import getcontainers, getroutes
 
 
 class WebsockifyToken(object):
-    # gets port from Container model from the
-    # username and container Id from the token
-    def __init__(self, *args, **kwargs):
-        self.containers = Container()
-
+    # gets the target from the shared routing table that the
+    # Container model publishes to, falling back to the model
+    # itself for tokens the table could not hold. The model is
+    # the process wide instance shared with DockerController,
+    # so containers whose registration has not been flushed
+    # yet can still be connected to. The target is the address
+    # of the docker host the container was placed on.
     def lookup(self, token):
+        route = getroutes().lookup(token)
+        if route:
+            return route
         username = token.split(":")[0]
         cid = token.split(":")[1]
-        port = self.containers.getport(username, cid)
+        target = getcontainers().gettarget(username, cid)
 
-        if port:
-            return ('127.0.0.1', port)
+        if target:
+            return target
         else:
             return None
@@ -0,0 +1,126 @@
+import mmap
+import multiprocessing
+import struct
+import time
+
+# Shared memory record of websocket proxy traffic per VNC port.
+#
+# The proxy forks a handler process per connection, so activity is
+# kept in an anonymous shared mapping created before the first fork.
+# There is one slot per host port from low up to but not including
+# high, a session's port is unique while it is registered, so no
+# lookup or allocation is needed. A slot holds the bytes proxied
+# (Q), the time of the last frame (d), the time of the last input
+# from the viewer (d) and the number of open connections (I).
+# Handlers update their slot under a lock shared by all processes.
+#
+# A viewer keeps asking for screen updates on its own, even in a
+# browser tab nobody looks at, so frames from the viewer only count
+# as input if they hold anything else: keys, the pointer or the
+# clipboard. Opening a connection counts as input too.
+#
+# The table doubles as websockify activity plugin: the proxy calls
+# opened and closed around a connection, received for every batch of
+# frames from the viewer and traffic for every frame from the
+# container.
+
+SLOT = struct.Struct('<QddI')
+
+# RFB FramebufferUpdateRequest, the message a viewer polls with
+
+UPDATE_REQUEST = 3
+UPDATE_REQUEST_SIZE = 10
+
+
+class ActivityTable(object):
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.lock = multiprocessing.Lock()
+        self.map = mmap.mmap(-1, (high - low) * SLOT.size)
+
+    def offset(self, port):
+        port = int(port)
+        if port < self.low or port >= self.high:
+            return None
+        return (port - self.low) * SLOT.size
+
+    # Whether a port has a slot. Ports outside low to high, those of
+    # sessions created before the range was set, are not recorded.
+
+    def tracks(self, port):
+        return self.offset(port) is not None
+
+    def update(self, port, nbytes, connections, userinput=False):
+        offset = self.offset(port)
+        if offset is None:
+            return
+        with self.lock:
+            total, lastframe, lastinput, count = SLOT.unpack_from(
+                self.map, offset)
+            now = time.time()
+            if userinput:
+                lastinput = now
+            SLOT.pack_into(self.map, offset, total + nbytes, now,
+                           lastinput, max(count + connections, 0))
+
+    def opened(self, port):
+        self.update(port, 0, 1, True)
+
+    def closed(self, port):
+        self.update(port, 0, -1)
+
+    def received(self, port, bufs):
+        self.update(port, sum([len(buf) for buf in bufs]), 0,
+                    any([isinput(buf) for buf in bufs]))
+
+    def traffic(self, port, nbytes):
+        self.update(port, nbytes, 0)
+
+    # Start a port over for a newly registered session, as if it had
+    # just seen a frame.
+
+    def reset(self, port):
+        offset = self.offset(port)
+        if offset is None:
+            return
+        with self.lock:
+            now = time.time()
+            SLOT.pack_into(self.map, offset, 0, now, now, 0)
+
+    # (bytes, time of the last frame, time of the last input, open
+    # connections) of a port
+
+    def get(self, port):
+        offset = self.offset(port)
+        if offset is None:
+            return (0, 0.0, 0.0, 0)
+        with self.lock:
+            return SLOT.unpack_from(self.map, offset)
+
+    def stats(self):
+        stats = {}
+        stats['ports'] = self.high - self.low
+        connections = 0
+        total = 0
+        with self.lock:
+            for index in range(self.high - self.low):
+                entry = SLOT.unpack_from(self.map, index * SLOT.size)
+                total += entry[0]
+                connections += entry[3]
+        stats['bytes'] = total
+        stats['connections'] = connections
+        return stats
+
+
+# False if a frame from the viewer holds nothing but update requests
+
+def isinput(buf):
+    data = bytearray(buf)
+    if len(data) % UPDATE_REQUEST_SIZE:
+        return True
+    for offset in range(0, len(data), UPDATE_REQUEST_SIZE):
+        if data[offset] != UPDATE_REQUEST:
+            return True
+    return False
@@ -0,0 +1,126 @@
+import tarfile
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Streaming of tar archives out of and into the daemon.
+#
+# An archive is passed on CHUNK_SIZE bytes at a time, optionally
+# compressed on the fly, so memory use does not depend on its size.
+# Uploads are read from the client only as fast as the daemon takes
+# them.
+# gzip is always available, zstd when the zstandard module is
+# installed, which compresses with one thread per core.
+#
+# Archives of a running container are not resumable: the daemon
+# builds them from the live file system, file times included, so
+# building one again gives different bytes as soon as anything in it
+# changed, and there is nothing to tell a client that it did.
+
+CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Encoding -> (file extension, content type)
+
+ENCODINGS = {
+    '': ('.tar', 'application/x-tar'),
+    'gzip': ('.tar.gz', 'application/gzip'),
+    'zstd': ('.tar.zst', 'application/zstd'),
+}
+
+
+class ArchiveTooLarge(Exception):
+    pass
+
+
+def available(encoding):
+    if encoding == 'zstd':
+        return zstandard is not None
+    return encoding in ENCODINGS
+
+
+# Chunks of a docker archive, which is a file like object from older
+# clients and an iterator of chunks from newer ones.
+
+def readchunks(data):
+    if hasattr(data, 'read'):
+        try:
+            while True:
+                chunk = data.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            data.close()
+    else:
+        for chunk in data:
+            if chunk:
+                yield chunk
+
+
+def compressed(chunks, encoding):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    elif encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL, threads=-1).compressobj()
+    else:
+        for chunk in chunks:
+            yield chunk
+        return
+    for chunk in chunks:
+        chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+# Chunks of an upload, failing with ArchiveTooLarge once more than
+# limit bytes arrived. total is the number of bytes read so far.
+
+class UploadReader(object):
+
+    def __init__(self, fp, limit):
+        self.fp = fp
+        self.limit = limit
+        self.total = 0
+
+    def __iter__(self):
+        while True:
+            chunk = self.fp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.total += len(chunk)
+            if self.total > self.limit:
+                raise ArchiveTooLarge(self.total)
+            yield chunk
+
+
+# A tar archive of a single file of size bytes, given as a stream of
+# chunks. The header needs the size up front, a stream that turns out
+# longer or shorter fails the archive rather than leaving a file with
+# the wrong contents.
+
+def singlefile(name, size, chunks, uid=0, gid=0):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    info.uid = uid
+    info.gid = gid
+    yield info.tobuf(tarfile.GNU_FORMAT)
+    written = 0
+    for chunk in chunks:
+        written += len(chunk)
+        if written > size:
+            raise IOError('upload longer than announced')
+        yield chunk
+    if written != size:
+        raise IOError('upload ended early')
+    yield b'\0' * (-size % tarfile.BLOCKSIZE)
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
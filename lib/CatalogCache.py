@@ -0,0 +1,69 @@
+import os
+import threading
+import binascii
+
+
+# Per user cache of the data behind the index page.
+#
+# Entries are versioned by a global generation, bumped by changes
+# that affect every user (base images), and a per user generation,
+# bumped by changes to that user's images or sessions. An entry is
+# rebuilt on the next request after either has moved, and its
+# versions double as the ETag of the page. The boot nonce keeps
+# ETags handed out before a restart from matching afterwards.
+
+class CatalogCache(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.boot = binascii.hexlify(os.urandom(4)).decode('ascii')
+        self.generation = 0
+        self.generations = {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def version(self, key):
+        return (self.generation, self.generations.get(key, 0))
+
+    # Returns (catalog, etag), calling builder(key) to create the
+    # catalog if there is no current one.
+
+    def get(self, key, builder):
+        with self.lock:
+            version = self.version(key)
+            entry = self.entries.get(key)
+            if entry and entry[0] == version:
+                self.hits += 1
+                return (entry[1], self.etag(version))
+            self.misses += 1
+        catalog = builder(key)
+        with self.lock:
+            if self.version(key) == version:
+                self.entries[key] = (version, catalog)
+        return (catalog, self.etag(version))
+
+    def etag(self, version):
+        return '"%s-%d-%d"' % (self.boot, version[0], version[1])
+
+    # Invalidate one user's catalog, or every catalog if key is None
+
+    def invalidate(self, key=None):
+        with self.lock:
+            self.invalidations += 1
+            if key is None:
+                self.generation += 1
+                self.entries = {}
+            else:
+                self.generations[key] = self.generations.get(key, 0) + 1
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['entries'] = len(self.entries)
+            stats['hits'] = self.hits
+            stats['misses'] = self.misses
+            stats['invalidations'] = self.invalidations
+            return stats
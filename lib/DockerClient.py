@@ -0,0 +1,311 @@
+import bisect
+import threading
+import time
+from docker import Client
+from requests import exceptions
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Thread safe docker client with a bounded pool of connections.
+#
+# Every call takes a docker.Client out of the pool, so no two
+# threads share a connection and at most POOL_SIZE requests are in
+# flight to the daemon; further callers wait for a connection to come
+# back, for at most ACQUIRE_TIMEOUT seconds before the call fails
+# with PoolTimeout. Connections are kept alive between calls.
+#
+# The timeout of a call depends on the operation, TIMEOUTS overrides
+# DEFAULT_TIMEOUT. Calls in IDEMPOTENT that fail because the
+# connection broke or timed out are retried up to RETRIES times on a
+# new connection, RETRY_DELAY seconds apart and twice as long every
+# time. Streams in STREAMING are not pooled, they run on a
+# connection of their own for as long as the caller reads or feeds
+# them, which is closed once the stream is read to the end or
+# closed.
+#
+# The latency of every call is kept per operation in a histogram
+# with the upper bounds in LATENCY_BUCKETS, in seconds.
+
+POOL_SIZE = 8
+ACQUIRE_TIMEOUT = 60
+DEFAULT_TIMEOUT = 30
+
+TIMEOUTS = {
+    'inspect_container': 5,
+    'inspect_image': 5,
+    'containers': 10,
+    'images': 10,
+    'exec_create': 10,
+    'exec_start': 30,
+    'create_container': 60,
+    'start': 60,
+    'restart': 60,
+    'remove_container': 60,
+    'remove_image': 120,
+    'tag': 10,
+    'commit': 600,
+    'export': 600,
+    'import_image_from_stream': 600,
+    'copy': 600,
+    'get_archive': 600,
+    'put_archive': 600,
+}
+
+IDEMPOTENT = set(['inspect_container',
+                  'inspect_image',
+                  'containers',
+                  'images',
+                  'version',
+                  'info',
+                  'tag'])
+
+STREAMING = set(['events', 'logs', 'attach', 'stats', 'copy',
+                 'get_archive', 'put_archive', 'export', 'get_image',
+                 'pull', 'push'])
+
+# Helpers that build arguments locally without calling the daemon
+
+LOCAL = set(['create_host_config', 'create_networking_config',
+             'create_endpoint_config'])
+
+TRANSIENT = (exceptions.ConnectionError, exceptions.Timeout)
+
+RETRIES = 2
+RETRY_DELAY = 0.1
+
+# Size of the chunks a streamed file like result is iterated in
+
+CHUNK_SIZE = 64 * 1024
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DockerClient(object):
+
+    def __init__(self, base_url, size=POOL_SIZE):
+        self.base_url = base_url
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.created = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.local = Client(base_url=base_url)
+        self.endpoints = {}
+
+    def __getattr__(self, name):
+        if name in LOCAL or not callable(getattr(Client, name, None)):
+            return getattr(self.local, name)
+
+        def call(*args, **kwargs):
+            return self.call(name, args, kwargs)
+        call.__name__ = name
+        return call
+
+    def newconnection(self):
+        return Client(base_url=self.base_url, timeout=DEFAULT_TIMEOUT)
+
+    # Take a connection out of the pool, opening a new one while the
+    # pool is below its size and waiting for one otherwise.
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                self.waits += 1
+                create = False
+        if create:
+            try:
+                return self.newconnection()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        try:
+            return self.idle.get(timeout=ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            with self.lock:
+                self.timeouts += 1
+            raise PoolTimeout('No docker connection free after %g seconds'
+                              % ACQUIRE_TIMEOUT)
+
+    def release(self, cli):
+        self.idle.put(cli)
+
+    # Drop a connection that failed, the next acquire opens a new one
+
+    def discard(self, cli):
+        closeconnection(cli)
+        with self.lock:
+            self.created -= 1
+
+    def call(self, name, args, kwargs):
+        if name in STREAMING:
+            return self.stream(name, args, kwargs)
+        attempts = 1
+        if name in IDEMPOTENT:
+            attempts += RETRIES
+        delay = RETRY_DELAY
+        for attempt in range(attempts):
+            cli = self.acquire()
+            cli.timeout = TIMEOUTS.get(name, DEFAULT_TIMEOUT)
+            start = time.time()
+            try:
+                result = getattr(cli, name)(*args, **kwargs)
+            except TRANSIENT:
+                self.record(name, time.time() - start, True, attempt)
+                self.discard(cli)
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+                continue
+            except Exception:
+                self.record(name, time.time() - start, True, attempt)
+                self.release(cli)
+                raise
+            self.record(name, time.time() - start, False, attempt)
+            self.release(cli)
+            return result
+
+    # Streams keep their connection busy until they are read to the
+    # end, so they get one outside of the pool. The latency recorded
+    # is the time to the start of the stream. get_archive returns
+    # the stream along with the archive's stat.
+
+    def stream(self, name, args, kwargs):
+        cli = self.newconnection()
+        if name in TIMEOUTS:
+            cli.timeout = TIMEOUTS[name]
+        start = time.time()
+        try:
+            result = getattr(cli, name)(*args, **kwargs)
+        except Exception:
+            self.record(name, time.time() - start, True, 0)
+            closeconnection(cli)
+            raise
+        self.record(name, time.time() - start, False, 0)
+        if isinstance(result, tuple):
+            return (closing(result[0], cli),) + result[1:]
+        return closing(result, cli)
+
+    def record(self, name, latency, failed, attempt):
+        with self.lock:
+            endpoint = self.endpoints.get(name)
+            if endpoint is None:
+                endpoint = {}
+                endpoint['calls'] = 0
+                endpoint['errors'] = 0
+                endpoint['retries'] = 0
+                endpoint['total'] = 0.0
+                endpoint['max'] = 0.0
+                endpoint['buckets'] = [0] * (len(LATENCY_BUCKETS) + 1)
+                self.endpoints[name] = endpoint
+            endpoint['calls'] += 1
+            if failed:
+                endpoint['errors'] += 1
+            if attempt:
+                endpoint['retries'] += 1
+            endpoint['total'] += latency
+            endpoint['max'] = max(endpoint['max'], latency)
+            endpoint['buckets'][bisect.bisect_left(LATENCY_BUCKETS,
+                                                   latency)] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['size'] = self.size
+            stats['connections'] = self.created
+            stats['idle'] = self.idle.qsize()
+            stats['waits'] = self.waits
+            stats['timeouts'] = self.timeouts
+            endpoints = {}
+            for name, endpoint in self.endpoints.items():
+                entry = {}
+                entry['calls'] = endpoint['calls']
+                entry['errors'] = endpoint['errors']
+                entry['retries'] = endpoint['retries']
+                entry['total'] = endpoint['total']
+                entry['max'] = endpoint['max']
+                entry['avg'] = endpoint['total'] / endpoint['calls']
+                histogram = {}
+                for bound, count in zip(LATENCY_BUCKETS,
+                                        endpoint['buckets']):
+                    histogram['le_%g' % bound] = count
+                histogram['inf'] = endpoint['buckets'][-1]
+                entry['histogram'] = histogram
+                endpoints[name] = entry
+            stats['endpoints'] = endpoints
+            return stats
+
+
+def closeconnection(cli):
+    try:
+        cli.close()
+    except Exception as e:
+        pass
+
+
+# The result of a stream, closing the connection it runs on when it
+# is done. A file like object is done once read to the end or
+# closed, an iterator once exhausted or closed. Anything else, like
+# the outcome of an upload, is complete already.
+
+def closing(result, cli):
+    if hasattr(result, 'read'):
+        return ClosingReader(result, cli)
+    if hasattr(result, '__next__') or hasattr(result, 'next'):
+        return closingiterator(result, cli)
+    closeconnection(cli)
+    return result
+
+
+def closingiterator(iterator, cli):
+    try:
+        for item in iterator:
+            yield item
+    finally:
+        closeconnection(cli)
+
+
+class ClosingReader(object):
+
+    def __init__(self, data, cli):
+        self.data = data
+        self.cli = cli
+
+    def __getattr__(self, name):
+        return getattr(self.data, name)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, *args):
+        chunk = self.data.read(*args)
+        if not chunk:
+            self.close()
+        return chunk
+
+    def close(self):
+        try:
+            self.data.close()
+        finally:
+            closeconnection(self.cli)
@@ -0,0 +1,117 @@
+import threading
+import time
+from lib.Services import getclient
+
+# Subscriber to the docker /events stream.
+#
+# A background thread follows the stream, which the client runs on a
+# connection of its own, and hands every event to the subscribed
+# callbacks. The stream is reopened after RETRY_INTERVAL seconds if
+# the daemon drops it. Watchers are told when the stream opens and
+# when it drops, events in between are lost and whatever was built
+# from them has to be checked again.
+
+RETRY_INTERVAL = 5.0
+
+
+class DockerEvents(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.watchers = []
+        self.thread = None
+        self.events = 0
+        self.errors = 0
+        self.reconnects = 0
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def watch(self, callback):
+        with self.lock:
+            self.watchers.append(callback)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                cli = getclient()
+                stream = cli.events(decode=True)
+                self.notify(True)
+                for event in stream:
+                    self.dispatch(event)
+            except Exception as e:
+                pass
+            self.notify(False)
+            self.reconnects += 1
+            time.sleep(RETRY_INTERVAL)
+
+    def dispatch(self, event):
+        self.events += 1
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                self.errors += 1
+
+    def notify(self, connected):
+        with self.lock:
+            watchers = list(self.watchers)
+        for callback in watchers:
+            try:
+                callback(connected)
+            except Exception as e:
+                self.errors += 1
+
+    def stats(self):
+        stats = {}
+        stats['events'] = self.events
+        stats['errors'] = self.errors
+        stats['reconnects'] = self.reconnects
+        stats['subscribers'] = len(self.subscribers)
+        return stats
+
+
+# Older daemons send {'status', 'id', 'from'}, newer ones add 'Type',
+# 'Action' and 'Actor'. These accessors work with both.
+
+def eventtype(event):
+    if 'Type' in event:
+        return event['Type']
+    if 'from' in event:
+        return 'container'
+    return 'image'
+
+
+def eventaction(event):
+    return event.get('Action', event.get('status', ''))
+
+
+def eventid(event):
+    if 'Actor' in event:
+        return event['Actor'].get('ID', event.get('id'))
+    return event.get('id')
+
+
+def eventattributes(event):
+    return event.get('Actor', {}).get('Attributes', {})
+
+
+# The image a container event refers to, or the name of the image
+# an image event refers to.
+
+def eventimage(event):
+    attributes = eventattributes(event)
+    if eventtype(event) == 'container':
+        return attributes.get('image', event.get('from', ''))
+    return attributes.get('name', event.get('id', ''))
@@ -0,0 +1,228 @@
+import threading
+import time
+from lib.Services import (getclient,
+                          gethost,
+                          getcontainers,
+                          getevents,
+                          getports)
+from lib.DockerEvents import eventtype, eventaction, eventid
+
+# In memory view of the daemon's containers and images.
+#
+# The view is loaded in full whenever the events stream (re)connects
+# and then kept current from the events alone. A container event
+# re-inspects just that container, image events mark the images
+# stale and they are listed again by the next reader, so a burst of
+# removals costs a single listing. While the stream is down the view
+# is not synced and readers get None, they then ask the daemon
+# themselves.
+#
+# Containers destroyed behind DockerLab's back are also dropped from
+# the Container registry and their ports go back to the allocator.
+# Only the daemon answering that a container does not exist counts
+# as destroyed. A container that could not be inspected, because the
+# daemon timed out or the connection broke, keeps what the view and
+# the registry hold about it until the next event or resync.
+#
+# The view follows the default docker host only, sessions placed on
+# other hosts are neither in it nor reconciled.
+#
+# Containers are kept as {'Id', 'Image', 'Name', 'Start', 'State',
+# 'Labels'}, images as {'Id', 'RepoTags'}.
+
+# Container actions that change what the view holds about one
+
+REFRESH = set(['create', 'start', 'restart', 'die', 'stop', 'kill',
+               'pause', 'unpause', 'rename', 'update'])
+
+
+class DockerState(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containerview = {}
+        self.imageview = {}
+        self.synced = False
+        self.imagesstale = False
+        self.resyncs = 0
+        self.updates = 0
+        self.errors = 0
+        self.reconciled = 0
+        getevents().subscribe(self.onevent)
+        getevents().watch(self.onconnection)
+
+    def onconnection(self, connected):
+        if connected:
+            self.resync()
+        else:
+            self.synced = False
+
+    # Load everything again, events may have been missed
+
+    def resync(self):
+        cli = getclient()
+        containerview = {}
+        for rinfo in cli.containers(all=True):
+            containerview[rinfo['Id']] = fromlisting(rinfo)
+        imageview = {}
+        for img in cli.images():
+            imageview[img['Id']] = fromimage(img)
+        with self.lock:
+            self.containerview = containerview
+            self.imageview = imageview
+            self.synced = True
+            self.resyncs += 1
+        containers = getcontainers()
+        for username, cid in containers.sessions():
+            if cid not in containerview:
+                self.reconcile(cid)
+
+    def onevent(self, event):
+        try:
+            if eventtype(event) == 'container':
+                action = eventaction(event)
+                if action == 'destroy':
+                    self.dropcontainer(eventid(event))
+                elif action in REFRESH:
+                    self.refreshcontainer(eventid(event))
+                elif action == 'commit':
+                    self.imagesstale = True
+            elif eventtype(event) == 'image':
+                self.imagesstale = True
+            self.updates += 1
+        except Exception as e:
+            self.errors += 1
+
+    def refreshcontainer(self, cid):
+        if not local(cid):
+            return
+        try:
+            rinfo = getclient().inspect_container(cid)
+        except Exception as e:
+            if not notfound(e):
+                raise
+            self.dropcontainer(cid)
+            return
+        with self.lock:
+            self.containerview[rinfo['Id']] = frominspect(rinfo)
+
+    def dropcontainer(self, cid):
+        with self.lock:
+            self.containerview.pop(cid, None)
+        self.reconcile(cid)
+
+    def loadimages(self):
+        self.imagesstale = False
+        imageview = {}
+        for img in getclient().images():
+            imageview[img['Id']] = fromimage(img)
+        with self.lock:
+            self.imageview = imageview
+
+    # Unregister a session whose container is gone. The listing of a
+    # resync may predate a launch, so the daemon is asked again
+    # before a session is dropped.
+
+    def reconcile(self, cid):
+        containers = getcontainers()
+        username = containers.owner_of(cid)
+        if not username or not local(cid):
+            return
+        try:
+            getclient().inspect_container(cid)
+            return
+        except Exception as e:
+            if not notfound(e):
+                self.errors += 1
+                return
+        container = containers.getcontainer(username, cid)
+        if containers.removecontainer(username, cid):
+            getports().release(container['port'])
+            self.reconciled += 1
+
+    # cid -> container, or None while not synced
+
+    def containers(self):
+        with self.lock:
+            if not self.synced:
+                return None
+            return dict(self.containerview)
+
+    # Images with a tag in a repository as (repotag, image ID), or
+    # None while not synced.
+
+    def imagesbyrepo(self, repository):
+        if self.synced and self.imagesstale:
+            self.loadimages()
+        with self.lock:
+            if not self.synced:
+                return None
+            images = []
+            for img in self.imageview.values():
+                for tag in img['RepoTags']:
+                    if tag.split(':')[0] == repository:
+                        images.append((tag, img['Id']))
+                        break
+            return images
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['synced'] = self.synced
+            stats['containers'] = len(self.containerview)
+            stats['images'] = len(self.imageview)
+            stats['resyncs'] = self.resyncs
+            stats['updates'] = self.updates
+            stats['errors'] = self.errors
+            stats['reconciled'] = self.reconciled
+            return stats
+
+
+# Whether a container is on the default host, as far as the
+# Container registry knows.
+
+def local(cid):
+    host = getcontainers().host_of(cid)
+    return host is None or host == gethost()['name']
+
+
+# Whether a call failed because the daemon has no such container,
+# as opposed to failing to answer at all.
+
+def notfound(error):
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None) == 404
+
+
+# Entries from the container listing, inspect_container and the
+# image listing.
+
+def fromlisting(rinfo):
+    container = {}
+    container['Id'] = rinfo['Id']
+    container['Image'] = rinfo['Image']
+    container['Name'] = rinfo['Names'][0].replace('/', '')
+    container['Start'] = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                       time.gmtime(rinfo['Created']))
+    container['State'] = rinfo.get('State', '')
+    container['Labels'] = rinfo.get('Labels') or {}
+    return container
+
+
+def frominspect(rinfo):
+    container = {}
+    container['Id'] = rinfo['Id']
+    container['Image'] = rinfo['Config']['Image']
+    container['Name'] = rinfo['Name'].replace('/', '')
+    container['Start'] = rinfo['State']['StartedAt']
+    container['State'] = rinfo['State'].get('Status', '')
+    container['Labels'] = rinfo['Config'].get('Labels') or {}
+    return container
+
+
+def fromimage(img):
+    image = {}
+    image['Id'] = img['Id']
+    image['RepoTags'] = [tag for tag in img.get('RepoTags') or []
+                         if tag != '<none>:<none>']
+    return image
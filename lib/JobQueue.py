@@ -0,0 +1,198 @@
+import binascii
+import os
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class JobsBusy(Exception):
+    pass
+
+
+# Raised by a job that cannot go on yet. The job goes back to the
+# queue after delay seconds, showing step, and its worker is free
+# for other jobs in the meantime.
+
+class RetryLater(Exception):
+
+    def __init__(self, delay, step=None):
+        Exception.__init__(self, step)
+        self.delay = delay
+        self.step = step
+
+
+# Bounded executor for slow docker operations.
+#
+# Every submitted operation becomes a job with an ID that can be
+# polled for its state: queued, running, done or failed. A fixed
+# number of worker threads run the jobs, at most maxqueued jobs may
+# wait for a worker, and finished jobs are forgotten after
+# RETENTION seconds. A running job can report what it is doing, and
+# how far along it is, with progress(), and can ask to be run again
+# later by raising RetryLater.
+
+RETENTION = 600.0
+
+
+class JobQueue(object):
+
+    def __init__(self, workers=4, maxqueued=100):
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxqueued)
+        self.jobs = {}
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retried = 0
+        self.threads = []
+        self.current = threading.local()
+        for i in range(workers):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    # Queue func(*args) on behalf of owner. redirect(result) gives
+    # the page to show once the job is done. Returns the job ID,
+    # raises JobsBusy if too many jobs are waiting already.
+
+    def submit(self, owner, kind, func, args=(), redirect=None):
+        jobid = binascii.hexlify(os.urandom(8)).decode('ascii')
+        job = {}
+        job['id'] = jobid
+        job['owner'] = owner
+        job['kind'] = kind
+        job['state'] = 'queued'
+        job['result'] = None
+        job['error'] = None
+        job['submitted'] = time.time()
+        job['started'] = None
+        job['finished'] = None
+        job['step'] = None
+        job['progress'] = None
+        job['retries'] = 0
+        job['func'] = func
+        job['args'] = args
+        job['redirect'] = redirect
+        with self.lock:
+            self.prune()
+            self.jobs[jobid] = job
+        try:
+            self.queue.put_nowait(jobid)
+        except queue.Full:
+            with self.lock:
+                del self.jobs[jobid]
+                self.rejected += 1
+            raise JobsBusy('Too many operations are waiting, '
+                           'try again later')
+        return jobid
+
+    def worker(self):
+        while True:
+            jobid = self.queue.get()
+            with self.lock:
+                job = self.jobs.get(jobid)
+                if job is None:
+                    continue
+                job['state'] = 'running'
+                job['started'] = time.time()
+            self.current.job = job
+            try:
+                result = job['func'](*job['args'])
+                state = 'done'
+                error = None
+            except RetryLater as e:
+                self.current.job = None
+                with self.lock:
+                    job['state'] = 'queued'
+                    job['step'] = e.step
+                    job['retries'] += 1
+                    self.retried += 1
+                timer = threading.Timer(e.delay, self.queue.put, (jobid,))
+                timer.daemon = True
+                timer.start()
+                continue
+            except Exception as e:
+                result = None
+                state = 'failed'
+                error = str(e) or e.__class__.__name__
+            self.current.job = None
+            with self.lock:
+                job['result'] = result
+                job['error'] = error
+                job['state'] = state
+                job['finished'] = time.time()
+                if state == 'done':
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    # Report the step the job running in this thread is at, and the
+    # fraction of the work done, if known. Does nothing outside of a
+    # job.
+
+    def progress(self, step, fraction=None):
+        job = getattr(self.current, 'job', None)
+        if job is None:
+            return
+        with self.lock:
+            job['step'] = step
+            job['progress'] = fraction
+
+    # Seconds since the job running in this thread was submitted, and
+    # how often it was retried, or None outside of a job.
+
+    def elapsed(self):
+        job = getattr(self.current, 'job', None)
+        if job is None:
+            return None
+        return time.time() - job['submitted']
+
+    def retries(self):
+        job = getattr(self.current, 'job', None)
+        if job is None:
+            return None
+        return job['retries']
+
+    def prune(self):
+        now = time.time()
+        for jobid, job in list(self.jobs.items()):
+            if job['finished'] and now - job['finished'] > RETENTION:
+                del self.jobs[jobid]
+
+    # Public view of a job, or None if there is no such job
+
+    def get(self, jobid):
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if job is None:
+                return None
+            info = {}
+            for key in ('id', 'owner', 'kind', 'state', 'error',
+                        'submitted', 'started', 'finished', 'step',
+                        'progress'):
+                info[key] = job[key]
+            if job['state'] == 'done':
+                info['result'] = job['result']
+                if job['redirect']:
+                    info['redirect'] = job['redirect'](job['result'])
+                else:
+                    info['redirect'] = '/'
+            return info
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['workers'] = len(self.threads)
+            stats['queued'] = len([job for job in self.jobs.values()
+                                   if job['state'] == 'queued'])
+            stats['running'] = len([job for job in self.jobs.values()
+                                    if job['state'] == 'running'])
+            stats['completed'] = self.completed
+            stats['failed'] = self.failed
+            stats['rejected'] = self.rejected
+            stats['retried'] = self.retried
+            return stats
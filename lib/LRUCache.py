@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+
+# Size bounded, thread safe least recently used cache.
+#
+# Meant for values that never change for a given key, such as the
+# metadata of an image ID, so entries are only ever evicted for
+# space and never expire.
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the cached value, or None
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['size'] = len(self.entries)
+            stats['maxsize'] = self.maxsize
+            stats['hits'] = self.hits
+            stats['misses'] = self.misses
+            stats['evictions'] = self.evictions
+            return stats
@@ -0,0 +1,42 @@
+import bisect
+import threading
+
+# Launch times by layer depth of the image launched.
+#
+# Launches are counted per depth bucket, the upper bounds are in
+# DEPTH_BUCKETS, with the total, largest and average time it took to
+# create and start the container. Deep image chains showing up as
+# slow launches is what the squash threshold is tuned against.
+
+DEPTH_BUCKETS = (1, 2, 5, 10, 20, 40, 80)
+
+
+class LaunchMetrics(object):
+
+    def __init__(self, buckets=DEPTH_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(buckets) + 1)
+        self.totals = [0.0] * (len(buckets) + 1)
+        self.maxima = [0.0] * (len(buckets) + 1)
+
+    def record(self, depth, seconds):
+        index = bisect.bisect_left(self.buckets, depth)
+        with self.lock:
+            self.counts[index] += 1
+            self.totals[index] += seconds
+            self.maxima[index] = max(self.maxima[index], seconds)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            names = ['le_%d' % bound for bound in self.buckets] + ['inf']
+            for index, name in enumerate(names):
+                if not self.counts[index]:
+                    continue
+                bucket = {}
+                bucket['launches'] = self.counts[index]
+                bucket['max'] = self.maxima[index]
+                bucket['avg'] = self.totals[index] / self.counts[index]
+                stats[name] = bucket
+            return stats
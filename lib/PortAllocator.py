@@ -0,0 +1,87 @@
+import threading
+
+
+class PortsExhausted(Exception):
+    pass
+
+
+# Allocator for the host ports published for container VNC servers.
+#
+# One bit per port in [low, high), set while the port is in use.
+# Reservation scans from a rotating cursor and skips fully used
+# bytes, so a reservation is O(1) amortized and recently released
+# ports are not handed out again straight away.
+
+class PortAllocator(object):
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.size = high - low
+        self.lock = threading.Lock()
+        self.bitmap = bytearray((self.size + 7) // 8)
+        self.used = 0
+        self.cursor = 0
+        self.exhausted = 0
+
+    def isused(self, index):
+        return self.bitmap[index >> 3] & (1 << (index & 7))
+
+    def setused(self, index):
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.used += 1
+
+    # Reserve a free port, raises PortsExhausted if there is none
+
+    def reserve(self):
+        with self.lock:
+            if self.used >= self.size:
+                self.exhausted += 1
+                raise PortsExhausted('All %d ports from %d to %d are in use'
+                                     % (self.size, self.low, self.high - 1))
+            index = self.cursor
+            for step in range(self.size):
+                if self.bitmap[index >> 3] == 0xff and not index & 7:
+                    index = (index + 8) % self.size
+                    continue
+                if not self.isused(index):
+                    self.setused(index)
+                    self.cursor = (index + 1) % self.size
+                    return self.low + index
+                index = (index + 1) % self.size
+            self.exhausted += 1
+            raise PortsExhausted('All %d ports from %d to %d are in use'
+                                 % (self.size, self.low, self.high - 1))
+
+    # Mark a known port as used, for rebuilding from the registry
+
+    def claim(self, port):
+        index = port - self.low
+        if index < 0 or index >= self.size:
+            return False
+        with self.lock:
+            if self.isused(index):
+                return False
+            self.setused(index)
+            return True
+
+    def release(self, port):
+        index = port - self.low
+        if index < 0 or index >= self.size:
+            return False
+        with self.lock:
+            if not self.isused(index):
+                return False
+            self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xff
+            self.used -= 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['low'] = self.low
+            stats['high'] = self.high
+            stats['used'] = self.used
+            stats['free'] = self.size - self.used
+            stats['exhausted'] = self.exhausted
+            return stats
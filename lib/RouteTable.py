@@ -0,0 +1,161 @@
+import mmap
+import struct
+import threading
+import zlib
+
+# Shared memory routing table for the websocket proxy.
+#
+# Maps a websockify token to the (host, port) of the container's VNC
+# server. The table lives in an anonymous shared mapping, so handler
+# processes forked by the proxy read the very table the web tier
+# keeps writing to, without a copy and without a daemon round trip.
+#
+# There is a single writer process. Readers take no lock; a
+# generation counter in the header is made odd while the writer
+# changes the table and even again when it is done, and a reader
+# retries when the generation was odd or moved while it was
+# probing.
+#
+# Layout: header of generation (Q) and entry count (I), followed by
+# SLOTS fixed size slots of state (B), token, host and port (H),
+# addressed by open addressing with linear probing.
+
+SLOTS = 4096
+TOKEN_SIZE = 160
+HOST_SIZE = 64
+
+HEADER = struct.Struct('<QI')
+SLOT = struct.Struct('<B%ds%dsH' % (TOKEN_SIZE, HOST_SIZE))
+
+EMPTY = 0
+USED = 1
+DELETED = 2
+
+
+class RouteTable(object):
+
+    def __init__(self, slots=SLOTS):
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.map = mmap.mmap(-1, HEADER.size + slots * SLOT.size)
+        self.entries = 0
+
+    def generation(self):
+        return HEADER.unpack_from(self.map, 0)[0]
+
+    def slotoffset(self, index):
+        return HEADER.size + index * SLOT.size
+
+    def probe(self, key):
+        index = (zlib.crc32(key) & 0xffffffff) % self.slots
+        for i in range(self.slots):
+            yield (index + i) % self.slots
+
+    # Returns (host, port) for a token, or None. Never blocks.
+
+    def lookup(self, token, retries=100):
+        key = token.encode('utf-8')
+        if len(key) > TOKEN_SIZE:
+            return None
+        for attempt in range(retries):
+            before = self.generation()
+            if before % 2:
+                continue
+            result = None
+            for index in self.probe(key):
+                state, slotkey, host, port = SLOT.unpack_from(
+                    self.map, self.slotoffset(index))
+                if state == EMPTY:
+                    break
+                if state == USED and slotkey.rstrip(b'\0') == key:
+                    result = (host.rstrip(b'\0').decode('utf-8'), port)
+                    break
+            if self.generation() == before:
+                return result
+        return None
+
+    def begin(self):
+        generation, entries = HEADER.unpack_from(self.map, 0)
+        HEADER.pack_into(self.map, 0, generation + 1, entries)
+
+    def end(self):
+        generation = HEADER.unpack_from(self.map, 0)[0]
+        HEADER.pack_into(self.map, 0, generation + 1, self.entries)
+
+    def find(self, key):
+        free = None
+        for index in self.probe(key):
+            state, slotkey, host, port = SLOT.unpack_from(
+                self.map, self.slotoffset(index))
+            if state == EMPTY:
+                if free is None:
+                    free = index
+                return (None, free)
+            if state == USED and slotkey.rstrip(b'\0') == key:
+                return (index, free)
+            if state == DELETED and free is None:
+                free = index
+        return (None, free)
+
+    # Add or update the route for a token. Returns False if the
+    # token does not fit in a slot or the table is full, readers
+    # then have to fall back to the container model.
+
+    def set(self, token, host, port):
+        key = token.encode('utf-8')
+        if len(key) > TOKEN_SIZE:
+            return False
+        with self.lock:
+            index, free = self.find(key)
+            if index is None:
+                if free is None:
+                    return False
+                index = free
+                self.entries += 1
+            self.begin()
+            SLOT.pack_into(self.map, self.slotoffset(index), USED,
+                           key, host.encode('utf-8'), int(port))
+            self.end()
+        return True
+
+    def remove(self, token):
+        key = token.encode('utf-8')
+        with self.lock:
+            index, free = self.find(key)
+            if index is None:
+                return False
+            self.entries -= 1
+            self.begin()
+            SLOT.pack_into(self.map, self.slotoffset(index), DELETED,
+                           b'', b'', 0)
+            self.end()
+        return True
+
+    # Replace the whole table with a mapping of token -> (host, port)
+
+    def replace(self, routes):
+        with self.lock:
+            self.begin()
+            self.map[HEADER.size:] = b'\0' * (self.slots * SLOT.size)
+            self.entries = 0
+            for token, (host, port) in routes.items():
+                key = token.encode('utf-8')
+                if len(key) > TOKEN_SIZE:
+                    continue
+                index, free = self.find(key)
+                if index is None:
+                    if free is None:
+                        break
+                    index = free
+                    self.entries += 1
+                SLOT.pack_into(self.map, self.slotoffset(index), USED,
+                               key, host.encode('utf-8'), int(port))
+            self.end()
+
+    def stats(self):
+        generation, entries = HEADER.unpack_from(self.map, 0)
+        stats = {}
+        stats['generation'] = generation
+        stats['entries'] = entries
+        stats['capacity'] = self.slots
+        return stats
@@ -0,0 +1,192 @@
+import threading
+
+# Process wide registry of shared services.
+#
+# The docker clients and the User and Container models are created
+# on first use and then shared by the web tier and the websocket
+# proxy, so the process holds one pool of connections per daemon
+# and a single copy of each database. Models are imported on demand to
+# keep this module free of import cycles, they use the client too.
+
+DOCKER_URL = 'unix://var/run/docker.sock'
+
+# Docker endpoints sessions are placed on: a name, the API URL and
+# the address at which the websocket proxy reaches the ports the
+# host publishes. The first one is the default host, it also keeps the
+# DockerLab databases, runs the warm pool and is the one followed
+# for events. Stand-in daemons on other sockets can be listed the
+# same way.
+
+DOCKER_HOSTS = [
+    {'name': 'local', 'url': DOCKER_URL, 'address': '127.0.0.1'},
+]
+
+# Connections to the daemon kept open and shared by all threads
+
+CLIENT_POOL_SIZE = 8
+
+# Host ports published for container VNC servers, PORT_LOW up to
+# but not including PORT_HIGH. Port 6000 is the websocket proxy.
+
+PORT_LOW = 6001
+PORT_HIGH = 7000
+
+# Worker threads running launch, save, commit, destroy and delete
+# operations, and how many operations may wait for a worker.
+
+JOB_WORKERS = 4
+JOB_QUEUE_SIZE = 100
+
+lock = threading.RLock()
+services = {}
+
+
+def getservice(name, factory):
+    service = services.get(name)
+    if service is None:
+        with lock:
+            service = services.get(name)
+            if service is None:
+                service = factory()
+                services[name] = service
+    return service
+
+
+def newclient(url=DOCKER_URL):
+    from lib.DockerClient import DockerClient
+    return DockerClient(url, CLIENT_POOL_SIZE)
+
+
+def newcontainers():
+    from model.Container import Container
+    return Container()
+
+
+def newroutes():
+    from lib.RouteTable import RouteTable
+    return RouteTable()
+
+
+def newevents():
+    from lib.DockerEvents import DockerEvents
+    return DockerEvents()
+
+
+def newstate():
+    from lib.DockerState import DockerState
+    return DockerState()
+
+
+def newports():
+    from lib.PortAllocator import PortAllocator
+    ports = PortAllocator(PORT_LOW, PORT_HIGH)
+    for port in getcontainers().ports.keys():
+        ports.claim(port)
+    return ports
+
+
+def newpool():
+    from controller.WarmPool import WarmPool
+    return WarmPool()
+
+
+def newcollector():
+    from controller.ImageCollector import ImageCollector
+    return ImageCollector()
+
+
+def newactivity():
+    from lib.ActivityTable import ActivityTable
+    return ActivityTable(PORT_LOW, PORT_HIGH)
+
+
+def newidle():
+    from controller.IdleManager import IdleManager
+    return IdleManager()
+
+
+def newadmission():
+    from controller.Admission import AdmissionController
+    return AdmissionController()
+
+
+def newjobs():
+    from lib.JobQueue import JobQueue
+    return JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE)
+
+
+def newusers():
+    from model.User import User
+    return User()
+
+
+# A Docker endpoint by name, the default host for None. Sessions
+# registered before there were several hosts have none.
+
+def gethost(name=None):
+    if name is None:
+        return DOCKER_HOSTS[0]
+    for host in DOCKER_HOSTS:
+        if host['name'] == name:
+            return host
+    raise KeyError('Unknown docker host ' + name)
+
+
+def hostnames():
+    return [host['name'] for host in DOCKER_HOSTS]
+
+
+# Client of a Docker endpoint, the default host's for None
+
+def getclient(host=None):
+    host = gethost(host)
+    return getservice('client:' + host['name'],
+                      lambda: newclient(host['url']))
+
+
+def getcontainers():
+    return getservice('containers', newcontainers)
+
+
+def getusers():
+    return getservice('users', newusers)
+
+
+def getroutes():
+    return getservice('routes', newroutes)
+
+
+def getevents():
+    return getservice('events', newevents)
+
+
+def getstate():
+    return getservice('state', newstate)
+
+
+def getports():
+    return getservice('ports', newports)
+
+
+def getpool():
+    return getservice('pool', newpool)
+
+
+def getcollector():
+    return getservice('collector', newcollector)
+
+
+def getactivity():
+    return getservice('activity', newactivity)
+
+
+def getidle():
+    return getservice('idle', newidle)
+
+
+def getadmission():
+    return getservice('admission', newadmission)
+
+
+def getjobs():
+    return getservice('jobs', newjobs)
@@ -87,6 +87,8 @@ Traffic Legend:
         self.print_traffic(self.traffic_legend)
 
         # Start proxying
+        if self.server.activity_plugin:
+            self.server.activity_plugin.opened(self.server.target_port)
         try:
             self.do_proxy(tsock)
         except:
@@ -97,6 +99,9 @@ Traffic Legend:
                     self.log_message("%s:%s: Closed target",
                             self.server.target_host, self.server.target_port)
             raise
+        finally:
+            if self.server.activity_plugin:
+                self.server.activity_plugin.closed(self.server.target_port)
 
     def get_target(self, target_plugin, path):
         """
@@ -130,6 +135,7 @@ Traffic Legend:
         c_pend = 0
         tqueue = []
         rlist = [self.request, target]
+        activity = self.server.activity_plugin
 
         if self.server.heartbeat:
             now = time.time()
@@ -174,6 +180,8 @@ Traffic Legend:
                 # Receive client data, decode it, and queue for target
                 bufs, closed = self.recv_frames()
                 tqueue.extend(bufs)
+                if activity and bufs:
+                    activity.received(self.server.target_port, bufs)
 
                 if closed:
                     # TODO: What about blocking on client socket?
@@ -206,6 +214,8 @@ Traffic Legend:
 
                 cqueue.append(buf)
                 self.print_traffic("{")
+                if activity:
+                    activity.traffic(self.server.target_port, len(buf))
 
 class WebSocketProxy(websocket.WebSocketServer):
     """
@@ -229,6 +239,7 @@ class WebSocketProxy(websocket.WebSocketServer):
 
         self.token_plugin = kwargs.pop('token_plugin', None)
         self.auth_plugin = kwargs.pop('auth_plugin', None)
+        self.activity_plugin = kwargs.pop('activity_plugin', None)
 
         # Last 3 timestamps command was run
         self.wrap_times    = [0, 0, 0]
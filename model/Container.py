@@ -1,10 +1,12 @@
-import json
-import hashlib
-import base64
-import zlib
-from docker import Client
+import threading
+from lib.Services import getroutes, gethost
+from model.Storage import getstore
+from model.ReadCache import ReadCache
 
-cli = Client(base_url='unix://var/run/docker.sock')
+# How often, in seconds, the backing store is checked for changes
+# made outside of this process.
+
+CACHE_INTERVAL = 5.0
 
 
 class Container(object):
@@ -12,38 +14,104 @@ class Container(object):
     containerDB = {}
 
     def __init__(self):
+        self.lock = threading.RLock()
+        self.store = getstore('container')
         self.containerDB = self.getdatabase()
+        self.buildindexes()
+        self.cache = ReadCache(self.loadsnapshot,
+                               self.store.version,
+                               CACHE_INTERVAL,
+                               self.reloaddatabase)
 
     def getdatabase(self):
-        container = cli.images('dockerlabconfig:container')
-        if container:
-            info = json.loads(cli.inspect_image(container[0]['Id'])['Comment'])
-        else:
-            self.createdatabase()
-            self.writedatabase()
-            container = cli.images('dockerlabconfig:container')
-            info = json.loads(cli.inspect_image(container[0]['Id'])['Comment'])
-        return info
-
-    def createdatabase(self):
-        nullimageenc = 'H4sIADODtVYAA+3PMQ6CQBAF0D3K3kB2V5bzmGhHIEHw' \
-                       '/BLUxkIrbHyv+ZPMFH/Ol9thWPo+7KhZ1Vq3XL3nNqdc' \
-                       '2zanklIXmpSPXQmx7FnqZbnOpynGMI3j/Onu2/7xR3rm' \
-                       'T6oDAAAAAAAAAADwv+7c8q/OACgAAA=='
-        nullimage = base64.b64decode(nullimageenc)
-        cli.import_image_from_data(zlib.decompress(nullimage,
-                                                   16 + zlib.MAX_WBITS),
-                                   'dockerlabconfig',
-                                   'container')
-
-    def writedatabase(self):
-        newcontainer = cli.create_container('dockerlabconfig:container',
-                                            '/dev/null')
-        cli.commit(newcontainer['Id'],
-                   'dockerlabconfig',
-                   'container',
-                   json.dumps(self.containerDB))
-        cli.remove_container(newcontainer['Id'])
+        if not self.store.exists():
+            self.store.create()
+        return self.store.load()
+
+    # Snapshot of the database for the read cache, taken from memory,
+    # which already holds every change made here. The cache hands the
+    # snapshot to readers in other threads and processes, so it
+    # shares no dict that gets mutated: container records are
+    # replaced on change, never changed in place.
+
+    def loadsnapshot(self):
+        with self.lock:
+            return dict([(username, dict(containers))
+                         for username, containers
+                         in self.containerDB.items()])
+
+    # Re-read the database after the store was changed from outside,
+    # the only time the indexes and the routing table are rebuilt
+    # whole. Changes made here update them one entry at a time.
+
+    def reloaddatabase(self):
+        with self.lock:
+            self.containerDB = self.store.load()
+            self.buildindexes()
+
+    # Secondary indexes over containerDB, cid -> owner, host port ->
+    # cid and image -> cids. They are only changed while holding the
+    # lock, together with the primary dict.
+
+    def buildindexes(self):
+        with self.lock:
+            self.owners = {}
+            self.ports = {}
+            self.images = {}
+            routes = {}
+            for username, containers in self.containerDB.items():
+                for cid, container in containers.items():
+                    self.indexcontainer(username, cid, container)
+                    routes[username + ':' + cid] = vnctarget(container)
+            getroutes().replace(routes)
+
+    def indexcontainer(self, username, cid, container):
+        self.owners[cid] = username
+        self.ports[container['port']] = cid
+        image = container.get('image')
+        if image:
+            self.images.setdefault(image, set()).add(cid)
+
+    def unindexcontainer(self, cid, container):
+        self.owners.pop(cid, None)
+        if self.ports.get(container['port']) == cid:
+            del self.ports[container['port']]
+        image = container.get('image')
+        if image in self.images:
+            self.images[image].discard(cid)
+            if not self.images[image]:
+                del self.images[image]
+
+    # Username owning a container, or None
+
+    def owner_of(self, cid):
+        return self.owners.get(cid)
+
+    # Docker host a container runs on, None for the default host
+
+    def host_of(self, cid):
+        with self.lock:
+            username = self.owners.get(cid)
+            if username is None:
+                return None
+            return self.containerDB[username][cid].get('host')
+
+    # Containers launched from an image
+
+    def containers_for_image(self, image):
+        with self.lock:
+            return list(self.images.get(image, ()))
+
+    # Write out any pending changes, used at shutdown.
+
+    def flush(self):
+        return self.store.flush()
+
+    def stats(self):
+        stats = self.store.stats()
+        stats['cache'] = self.cache.stats()
+        stats['routes'] = getroutes().stats()
+        return stats
 
     def getcontainer(self, username, cid):
         containers = self.getcontainers(username)
@@ -58,38 +126,79 @@ class Container(object):
         else:
             return {}
 
-    def addcontainer(self, username, cid, port, vnckey):
-        containers = self.getcontainers(username)
-        container = {}
-        container['port'] = port
-        container['vnckey'] = vnckey
-        if not containers:
-            self.containerDB[username] = {}
-            containers = self.containerDB[username]
-        containers[cid] = container
-        self.writedatabase()
+    # (username, cid) of every registered session
+
+    def sessions(self):
+        with self.lock:
+            return [(username, cid)
+                    for username, containers in self.containerDB.items()
+                    for cid in containers.keys()]
+
+    def addcontainer(self, username, cid, port, vnckey, image=None,
+                     profile=None, host=None):
+        with self.lock:
+            containers = self.getcontainers(username)
+            container = {}
+            container['port'] = port
+            container['vnckey'] = vnckey
+            if image:
+                container['image'] = image
+            if profile:
+                container['profile'] = profile
+            if host:
+                container['host'] = host
+            if not containers:
+                self.containerDB[username] = {}
+                containers = self.containerDB[username]
+            if cid in containers:
+                self.unindexcontainer(cid, containers[cid])
+            containers[cid] = container
+            self.indexcontainer(username, cid, container)
+            address, port = vnctarget(container)
+            getroutes().set(username + ':' + cid, address, port)
+            self.store.putfield(username, cid, container)
+        self.cache.invalidate()
         return True
 
     def removecontainer(self, username, cid):
-        if username in self.containerDB.keys():
-            if cid in self.containerDB[username].keys():
-                del self.containerDB[username][cid]
-                self.writedatabase()
-                return True
+        with self.lock:
+            if username in self.containerDB.keys():
+                if cid in self.containerDB[username].keys():
+                    self.unindexcontainer(cid,
+                                          self.containerDB[username][cid])
+                    del self.containerDB[username][cid]
+                    getroutes().remove(username + ':' + cid)
+                    self.store.deletefield(username, cid)
+                    self.cache.invalidate()
+                    return True
         return False
 
     def setvncpassword(self, username, cid, vnckey):
-        if username in self.containerDB.keys():
-            if cid in self.containerDB[username].keys():
-                self.containerDB[username][cid]['vnckey'] = vnckey
-                self.writedatabase()
-                return True
+        with self.lock:
+            if username in self.containerDB.keys():
+                if cid in self.containerDB[username].keys():
+                    container = dict(self.containerDB[username][cid])
+                    container['vnckey'] = vnckey
+                    self.containerDB[username][cid] = container
+                    self.store.putfield(username, cid, container)
+                    self.cache.invalidate()
+                    return True
         return False
 
-    def getport(self, username, cid):
-        self.containerDB = self.getdatabase()
-        containers = self.getcontainers(username)
+    # (address, port) the websocket proxy connects to, or False.
+    # Used for every connection, answered from the read cache
+    # without touching the docker daemon.
+
+    def gettarget(self, username, cid):
+        containers = self.cache.get().get(username)
         if containers:
             if cid in containers.keys():
-                return containers[cid]['port']
+                return vnctarget(containers[cid])
         return False
+
+
+# Address and port of a container's VNC server as seen from the
+# websocket proxy, the port is published on the container's host.
+
+def vnctarget(container):
+    return (gethost(container.get('host'))['address'], container['port'])
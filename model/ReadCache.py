@@ -0,0 +1,104 @@
+import threading
+import multiprocessing
+
+
+# Versioned read cache for a model database.
+#
+# Readers get an immutable snapshot built by loader(). The snapshot
+# is rebuilt only after invalidate() has been called, which the
+# model does on its own mutations, or when version() reports that
+# the backing store was changed from elsewhere. version() is polled
+# by a background thread, never on the read path. On such a change
+# refresh() is called first, for the model to re-read the store; its
+# own mutations it already holds.
+#
+# The websocket proxy reads from processes forked per connection,
+# so a stale snapshot is rebuilt ahead of time by the background
+# thread instead of lazily by the reader, and the hit/miss counters
+# live in shared memory so that the forked readers are counted.
+
+class ReadCache(object):
+
+    def __init__(self, loader, version=None, interval=5.0, refresh=None):
+        self.loader = loader
+        self.version = version
+        self.refresh = refresh
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.snapshot = None
+        self.generation = 0
+        self.loadedgeneration = -1
+        self.backingversion = None
+        self.hits = multiprocessing.Value('L', 0)
+        self.misses = multiprocessing.Value('L', 0)
+        self.reloads = multiprocessing.Value('L', 0)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self):
+        with self.lock:
+            if self.loadedgeneration == self.generation:
+                snapshot = self.snapshot
+            else:
+                snapshot = None
+        if snapshot is not None:
+            with self.hits.get_lock():
+                self.hits.value += 1
+            return snapshot
+        with self.misses.get_lock():
+            self.misses.value += 1
+        return self.reload()
+
+    def reload(self):
+        with self.lock:
+            generation = self.generation
+        snapshot = self.loader()
+        with self.lock:
+            if generation == self.generation:
+                self.snapshot = snapshot
+                self.loadedgeneration = generation
+        with self.reloads.get_lock():
+            self.reloads.value += 1
+        return snapshot
+
+    # Mark the snapshot stale and have it rebuilt in the background.
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                if self.version:
+                    version = self.version()
+                    if version != self.backingversion:
+                        if self.backingversion is not None:
+                            if self.refresh:
+                                self.refresh()
+                            with self.lock:
+                                self.generation += 1
+                        self.backingversion = version
+                with self.lock:
+                    stale = self.loadedgeneration != self.generation
+                if stale:
+                    self.reload()
+            except Exception as e:
+                # Retried on the next interval, readers fall back
+                # to loading the snapshot themselves.
+                pass
+
+    def stats(self):
+        stats = {}
+        stats['hits'] = self.hits.value
+        stats['misses'] = self.misses.value
+        stats['reloads'] = self.reloads.value
+        with self.lock:
+            stats['generation'] = self.generation
+            stats['stale'] = self.loadedgeneration != self.generation
+        return stats
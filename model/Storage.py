@@ -0,0 +1,556 @@
+import json
+import base64
+import zlib
+import sqlite3
+import threading
+import time
+import sys
+import os
+from lib.Services import getclient
+from model.WriteBehind import WriteBehind
+
+# Storage backends for the User and Container models.
+#
+# Both models keep a database that is a mapping of a top level key
+# (the username) to a JSON record. A backend persists that mapping
+# one record at a time:
+#
+#   exists()          True if the database has been created
+#   create()          creates an empty database
+#   load()            returns the whole mapping
+#   get(key)          returns one record, or None
+#   put(key, value)   stores one record
+#   delete(key)       removes one record
+#   putfield(key, field, value)
+#                     stores one field of a record, creating the
+#                     record if needed
+#   deletefield(key, field)
+#                     removes one field of a record
+#   flush()           writes out anything still pending
+#   version()         changes whenever the stored data is changed
+#                     other than through this backend object
+#   stats()           backend statistics
+#
+# 'image' keeps the original layout, the mapping is one JSON object
+# in the comment of the dockerlabconfig:<name> image. 'sqlite' keeps
+# one row per key in an embedded database. 'journal' appends every
+# change to a log file and periodically compacts it into a snapshot.
+# Existing installations can be moved from the image comments to
+# one of the latter two with
+#
+#   python -m model.Storage migrate [sqlite|journal]
+
+STORAGE = 'image'
+SQLITE_PATH = '/opt/dockerlab/dockerlab.db'
+JOURNAL_PATH = '/opt/dockerlab/journal'
+
+# A journal is compacted into its snapshot once it holds
+# COMPACT_ENTRIES changes, or every COMPACT_INTERVAL seconds if it
+# holds any.
+
+COMPACT_ENTRIES = 1000
+COMPACT_INTERVAL = 300.0
+
+# Changes to an image store are committed by a background flusher,
+# at most once per FLUSH_INTERVAL seconds or as soon as FLUSH_BATCH
+# keys have changed.
+
+FLUSH_INTERVAL = 2.0
+FLUSH_BATCH = 50
+
+
+def getstore(name):
+    if STORAGE == 'sqlite':
+        return SQLiteStore(name, SQLITE_PATH)
+    if STORAGE == 'journal':
+        return JournalStore(name, JOURNAL_PATH)
+    return ImageCommentStore(name)
+
+
+# The whole database is a single docker image comment. Records are
+# kept serialized so a change only costs encoding that one record,
+# and the comment is assembled from them when the write-behind
+# flusher commits a new image.
+#
+# A null image is imported once, tagged dockerlabconfig:<name>-base
+# so readers never see it in place of the database, and every write
+# commits the comment on top of it. The new image does not have the
+# previous one as its parent, so the previous image loses its tag
+# and nothing refers to it any more, the image collector removes it.
+# Committing on top of the previous image instead would keep every
+# version ever written alive as an ancestor.
+
+NULL_IMAGE = ('H4sIADODtVYAA+3PMQ6CQBAF0D3K3kB2V5bzmGhHIEHw'
+              '/BLUxkIrbHyv+ZPMFH/Ol9thWPo+7KhZ1Vq3XL3nNqdc'
+              '2zanklIXmpSPXQmx7FnqZbnOpynGMI3j/Onu2/7xR3rm'
+              'T6oDAAAAAAAAAADwv+7c8q/OACgAAA==')
+
+class ImageCommentStore(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.repotag = 'dockerlabconfig:' + name
+        self.basetag = 'dockerlabconfig:' + name + '-base'
+        self.lock = threading.RLock()
+        self.rows = {}
+        self.loaded = False
+        self.written = None
+        self.seen = None
+        self.writer = WriteBehind(self.flushdatabase,
+                                  FLUSH_INTERVAL,
+                                  FLUSH_BATCH)
+
+    def exists(self):
+        if getclient().images(self.repotag):
+            return True
+        return False
+
+    def create(self):
+        with self.lock:
+            self.rows = {}
+            self.loaded = True
+        self.writedatabase()
+
+    def readdatabase(self):
+        cli = getclient()
+        image = cli.images(self.repotag)
+        comment = cli.inspect_image(image[0]['Id'])['Comment']
+        rows = {}
+        for key, value in json.loads(comment).items():
+            rows[key] = json.dumps(value)
+        with self.lock:
+            self.rows = rows
+            self.loaded = True
+
+    # Re-read the image unless it is behind memory because writes
+    # are still pending.
+
+    def refresh(self):
+        with self.lock:
+            if not self.writer.pending():
+                self.readdatabase()
+
+    def writedatabase(self):
+        with self.lock:
+            comment = '{' + ', '.join([json.dumps(key) + ': ' + value
+                                       for key, value
+                                       in self.rows.items()]) + '}'
+        cli = getclient()
+        if not cli.images(self.basetag):
+            nullimage = base64.b64decode(NULL_IMAGE)
+            cli.import_image_from_data(zlib.decompress(nullimage,
+                                                       16 + zlib.MAX_WBITS),
+                                       'dockerlabconfig',
+                                       self.name + '-base')
+        newcontainer = cli.create_container(self.basetag, '/dev/null')
+        image = cli.commit(newcontainer['Id'],
+                           'dockerlabconfig',
+                           self.name,
+                           comment)
+        with self.lock:
+            self.written = image.get('Id')
+        cli.remove_container(newcontainer['Id'])
+
+    # Called by the write-behind flusher with the keys that changed
+    # since the last flush. A batch of any size costs one commit.
+
+    def flushdatabase(self, batch):
+        self.writedatabase()
+
+    def load(self):
+        self.refresh()
+        with self.lock:
+            return dict([(key, json.loads(value))
+                         for key, value in self.rows.items()])
+
+    def get(self, key):
+        self.refresh()
+        with self.lock:
+            value = self.rows.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def put(self, key, value):
+        encoded = json.dumps(value)
+        with self.lock:
+            self.rows[key] = encoded
+        self.writer.mark(key)
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.rows:
+                del self.rows[key]
+        self.writer.mark(key)
+
+    def putfield(self, key, field, value):
+        with self.lock:
+            record = json.loads(self.rows.get(key, '{}'))
+            record[field] = value
+            self.rows[key] = json.dumps(record)
+        self.writer.mark(key)
+
+    def deletefield(self, key, field):
+        with self.lock:
+            if key not in self.rows:
+                return
+            record = json.loads(self.rows[key])
+            if field in record:
+                del record[field]
+                self.rows[key] = json.dumps(record)
+        self.writer.mark(key)
+
+    def flush(self):
+        return self.writer.flush()
+
+    # Every commit produces a new image, so its ID versions the data.
+    # The image this store committed last is its own write and keeps
+    # the version it had.
+
+    def version(self):
+        image = getclient().images(self.repotag)
+        if not image:
+            return None
+        with self.lock:
+            if self.seen is None or image[0]['Id'] != self.written:
+                self.seen = image[0]['Id']
+            return self.seen
+
+    def stats(self):
+        stats = self.writer.stats()
+        stats['backend'] = 'image'
+        return stats
+
+
+# One row per key in an SQLite database running in WAL mode, so
+# point lookups go through the primary key index and a change is a
+# single row upsert. Each model gets a table named after it.
+
+class SQLiteStore(object):
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.lock = threading.RLock()
+        self.reads = 0
+        self.writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+    def exists(self):
+        with self.lock:
+            row = self.db.execute('SELECT name FROM sqlite_master '
+                                  'WHERE type = ? AND name = ?',
+                                  ('table', self.name)).fetchone()
+        if row:
+            return True
+        return False
+
+    def create(self):
+        with self.lock:
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS "%s" '
+                                '(key TEXT PRIMARY KEY, '
+                                'value TEXT NOT NULL)' % self.name)
+
+    def load(self):
+        with self.lock:
+            self.reads += 1
+            rows = self.db.execute('SELECT key, value FROM "%s"' %
+                                   self.name).fetchall()
+        return dict([(key, json.loads(value)) for key, value in rows])
+
+    def get(self, key):
+        with self.lock:
+            self.reads += 1
+            row = self.db.execute('SELECT value FROM "%s" WHERE key = ?' %
+                                  self.name, (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        self.putmany([(key, value)])
+
+    def putmany(self, items):
+        items = [(key, json.dumps(value)) for key, value in items]
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO "%s" '
+                                    '(key, value) VALUES (?, ?)' %
+                                    self.name, items)
+            self.writes += len(items)
+
+    def delete(self, key):
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM "%s" WHERE key = ?' %
+                                self.name, (key,))
+            self.writes += 1
+
+    def putfield(self, key, field, value):
+        with self.lock:
+            record = self.get(key) or {}
+            record[field] = value
+            self.put(key, record)
+
+    def deletefield(self, key, field):
+        with self.lock:
+            record = self.get(key)
+            if record is not None and field in record:
+                del record[field]
+                self.put(key, record)
+
+    def flush(self):
+        return 0
+
+    # Changes whenever another connection commits to the database.
+
+    def version(self):
+        with self.lock:
+            return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['backend'] = 'sqlite'
+            stats['reads'] = self.reads
+            stats['writes'] = self.writes
+            return stats
+
+
+# Every change is appended to <path>/<name>.journal as one JSON
+# line, so a write costs the size of the change rather than the size
+# of the database. The state is rebuilt at startup by replaying the
+# journal over <path>/<name>.snapshot, and a background thread
+# compacts the journal into a new snapshot to bound the replay.
+
+class JournalStore(object):
+
+    def __init__(self, name, path):
+        self.name = name
+        self.snapshotpath = os.path.join(path, name + '.snapshot')
+        self.journalpath = os.path.join(path, name + '.journal')
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.db = None
+        self.journal = None
+        self.entries = 0
+        self.replayed = 0
+        self.compactions = 0
+        self.lastcompaction = 0.0
+        self.written = None
+        self.seen = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def exists(self):
+        return os.path.exists(self.snapshotpath)
+
+    def create(self):
+        with self.lock:
+            self.db = {}
+            self.writesnapshot()
+            self.journal = open(self.journalpath, 'w')
+            self.entries = 0
+
+    # Rebuild the state from the snapshot and the journal. A torn
+    # last line, left by a crash in the middle of an append, is
+    # dropped and cut off the journal, new entries appended after it
+    # would otherwise be lost along with it on the next replay.
+
+    def replay(self):
+        with open(self.snapshotpath) as snapshot:
+            db = json.load(snapshot)
+        entries = 0
+        if os.path.exists(self.journalpath):
+            good = 0
+            with open(self.journalpath, 'rb') as journal:
+                for line in journal:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    self.apply(db, entry)
+                    entries += 1
+                    good += len(line)
+            if good < os.path.getsize(self.journalpath):
+                with open(self.journalpath, 'r+b') as journal:
+                    journal.truncate(good)
+        self.db = db
+        self.entries = entries
+        self.replayed = entries
+        self.journal = open(self.journalpath, 'a')
+
+    def apply(self, db, entry):
+        op = entry['op']
+        key = entry['key']
+        if op == 'put':
+            db[key] = entry['value']
+        elif op == 'delete':
+            db.pop(key, None)
+        elif op == 'putfield':
+            db.setdefault(key, {})[entry['field']] = entry['value']
+        elif op == 'deletefield':
+            if key in db:
+                db[key].pop(entry['field'], None)
+
+    def append(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            if self.db is None:
+                self.replay()
+            self.journal.write(line)
+            self.journal.flush()
+            self.apply(self.db, entry)
+            self.entries += 1
+            self.written = self.journalstat()
+            full = self.entries >= COMPACT_ENTRIES
+        if full:
+            self.wakeup.set()
+
+    def load(self):
+        with self.lock:
+            if self.db is None:
+                self.replay()
+            return json.loads(json.dumps(self.db))
+
+    def get(self, key):
+        with self.lock:
+            if self.db is None:
+                self.replay()
+            value = self.db.get(key)
+            if value is None:
+                return None
+            return json.loads(json.dumps(value))
+
+    def put(self, key, value):
+        self.append({'op': 'put', 'key': key, 'value': value})
+
+    def delete(self, key):
+        self.append({'op': 'delete', 'key': key})
+
+    def putfield(self, key, field, value):
+        self.append({'op': 'putfield', 'key': key,
+                     'field': field, 'value': value})
+
+    def deletefield(self, key, field):
+        self.append({'op': 'deletefield', 'key': key, 'field': field})
+
+    def writesnapshot(self):
+        tmppath = self.snapshotpath + '.tmp'
+        with open(tmppath, 'w') as snapshot:
+            json.dump(self.db, snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(tmppath, self.snapshotpath)
+
+    # Fold the journal into a new snapshot and start an empty one.
+    # The snapshot is renamed into place before the journal is
+    # truncated, so a crash in between only replays entries that
+    # are already part of the snapshot.
+
+    def compact(self):
+        with self.lock:
+            if self.db is None or not self.entries:
+                return 0
+            start = time.time()
+            entries = self.entries
+            self.writesnapshot()
+            self.journal.close()
+            self.journal = open(self.journalpath, 'w')
+            self.entries = 0
+            self.written = self.journalstat()
+            self.compactions += 1
+            self.lastcompaction = time.time() - start
+            return entries
+
+    def run(self):
+        while True:
+            self.wakeup.wait(COMPACT_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                # The journal is intact, compaction is retried
+                # on the next interval.
+                pass
+
+    def flush(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            return 0
+
+    # Every change and every compaction alters the journal's size or
+    # inode. Those made here are recorded as they are made and keep
+    # the version it had.
+
+    def journalstat(self):
+        try:
+            stat = os.stat(self.journalpath)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size)
+
+    def version(self):
+        with self.lock:
+            stat = self.journalstat()
+            if self.seen is None or stat != self.written:
+                self.seen = stat
+            return self.seen
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['backend'] = 'journal'
+            stats['entries'] = self.entries
+            stats['replayed'] = self.replayed
+            stats['compactions'] = self.compactions
+            stats['last_compaction'] = self.lastcompaction
+            return stats
+
+
+# One-shot migration of a database from its image comment into
+# SQLite or a journal. Records already present in the target are
+# overwritten.
+
+def migrate(name, target='sqlite'):
+    source = ImageCommentStore(name)
+    if not source.exists():
+        return 0
+    records = source.load()
+    if target == 'journal':
+        store = JournalStore(name, JOURNAL_PATH)
+        if store.exists():
+            store.load()
+        else:
+            store.create()
+        for key, value in records.items():
+            store.put(key, value)
+        store.compact()
+    else:
+        store = SQLiteStore(name, SQLITE_PATH)
+        store.create()
+        store.putmany(records.items())
+    return len(records)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print('usage: python -m model.Storage migrate [sqlite|journal]')
+        sys.exit(1)
+    target = 'sqlite'
+    if len(sys.argv) > 2:
+        target = sys.argv[2]
+    for name in ('auth', 'container'):
+        print('%s: migrated %d records to %s' % (name,
+                                                 migrate(name, target),
+                                                 target))
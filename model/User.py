@@ -1,10 +1,5 @@
-import json
 import hashlib
-import base64
-import zlib
-from docker import Client
-
-cli = Client(base_url='unix://var/run/docker.sock')
+from model.Storage import getstore
 
 
 class User(object):
@@ -12,42 +7,26 @@ class User(object):
     userDB = {}
 
     def __init__(self):
+        self.store = getstore('auth')
         self.userDB = self.getdatabase()
 
     def getdatabase(self):
-        container = cli.images('dockerlabconfig:auth')
-        if container:
-            info = json.loads(cli.inspect_image(container[0]['Id'])['Comment'])
-        else:
-            self.createdatabase()
+        if not self.store.exists():
+            self.store.create()
             self.initdatabase()
-            container = cli.images('dockerlabconfig:auth')
-            info = json.loads(cli.inspect_image(container[0]['Id'])['Comment'])
-        return info
-
-    def createdatabase(self):
-        nullimageenc = 'H4sIADODtVYAA+3PMQ6CQBAF0D3K3kB2V5bzmGhHIEHw' \
-                       '/BLUxkIrbHyv+ZPMFH/Ol9thWPo+7KhZ1Vq3XL3nNqdc' \
-                       '2zanklIXmpSPXQmx7FnqZbnOpynGMI3j/Onu2/7xR3rm' \
-                       'T6oDAAAAAAAAAADwv+7c8q/OACgAAA=='
-        nullimage = base64.b64decode(nullimageenc)
-        cli.import_image_from_data(zlib.decompress(nullimage,
-                                                   16 + zlib.MAX_WBITS),
-                                   'dockerlabconfig',
-                                   'auth')
+        return self.store.load()
 
     def initdatabase(self):
         self.adduser('admin', 'notsecret', 'admin', 'Default ADMIN account.')
         self.adduser('user', 'notsecret', 'user', 'Default USER account.')
 
-    def writedatabase(self):
-        newcontainer = cli.create_container('dockerlabconfig:auth',
-                                            '/dev/null')
-        cli.commit(newcontainer['Id'],
-                   'dockerlabconfig',
-                   'auth',
-                   json.dumps(self.userDB))
-        cli.remove_container(newcontainer['Id'])
+    # Write out any pending changes, used at shutdown.
+
+    def flush(self):
+        return self.store.flush()
+
+    def stats(self):
+        return self.store.stats()
 
     def checkuserpass(self, username, password):
         user = self.getuser(username)
@@ -71,6 +50,7 @@ class User(object):
             userrecord['comment'] = comment
             self.userDB[username] = {}
             self.userDB[username] = userrecord
+            self.store.put(username, userrecord)
             self.setpassword(username, password)
             return True
 
@@ -93,7 +73,7 @@ class User(object):
             passhasher.update(password)
             passhash = passhasher.hexdigest()
             self.userDB[username]['password'] = passhash
-            self.writedatabase()
+            self.store.putfield(username, 'password', passhash)
             return True
         else:
             return False
@@ -105,9 +85,9 @@ class User(object):
             return False
 
     def deleteuser(self, username):
-        if getuser(username):
-            del userDB[username]
-            self.writedatabase()
+        if self.getuser(username):
+            del self.userDB[username]
+            self.store.delete(username)
             return True
         else:
             return False
@@ -0,0 +1,114 @@
+import threading
+import time
+
+
+# Write-behind persistence for the models.
+#
+# Mutations only mark a key as dirty; a background thread hands
+# the accumulated set to the writer once per interval, or as soon
+# as maxpending keys have piled up. Many changes made in quick
+# succession therefore cost a single commit against the docker
+# daemon instead of one commit each, and the request thread never
+# waits on it.
+
+class WriteBehind(object):
+
+    def __init__(self, writer, interval=2.0, maxpending=50):
+        self.writer = writer
+        self.interval = interval
+        self.maxpending = maxpending
+        self.dirty = set()
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.flushlock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.flushes = 0
+        self.errors = 0
+        self.lastbatch = 0
+        self.maxbatch = 0
+        self.totalbatch = 0
+        self.lastlatency = 0.0
+        self.maxlatency = 0.0
+        self.totallatency = 0.0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Record a changed key. The write happens later, from the
+    # flusher thread.
+
+    def mark(self, key):
+        with self.lock:
+            self.dirty.add(key)
+            full = len(self.dirty) >= self.maxpending
+        if full:
+            self.wakeup.set()
+
+    # Number of changed keys not yet written, including a batch that
+    # is being written right now.
+
+    def pending(self):
+        with self.lock:
+            return len(self.dirty) + self.inflight
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # The batch is put back by flush(), the next
+                # interval retries it.
+                pass
+
+    # Write out everything that is pending. Safe to call from any
+    # thread, and must be called at shutdown so that no change is
+    # lost. Returns the number of keys written.
+
+    def flush(self):
+        with self.flushlock:
+            with self.lock:
+                batch = self.dirty
+                self.dirty = set()
+                self.inflight = len(batch)
+            if not batch:
+                return 0
+            start = time.time()
+            try:
+                self.writer(batch)
+            except Exception:
+                with self.lock:
+                    self.dirty |= batch
+                    self.inflight = 0
+                    self.errors += 1
+                raise
+            latency = time.time() - start
+            with self.lock:
+                self.inflight = 0
+                self.flushes += 1
+                self.lastbatch = len(batch)
+                self.maxbatch = max(self.maxbatch, len(batch))
+                self.totalbatch += len(batch)
+                self.lastlatency = latency
+                self.maxlatency = max(self.maxlatency, latency)
+                self.totallatency += latency
+            return len(batch)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            stats['pending'] = len(self.dirty) + self.inflight
+            stats['flushes'] = self.flushes
+            stats['errors'] = self.errors
+            stats['last_batch'] = self.lastbatch
+            stats['max_batch'] = self.maxbatch
+            stats['last_latency'] = self.lastlatency
+            stats['max_latency'] = self.maxlatency
+            if self.flushes:
+                stats['avg_batch'] = float(self.totalbatch) / self.flushes
+                stats['avg_latency'] = self.totallatency / self.flushes
+            else:
+                stats['avg_batch'] = 0.0
+                stats['avg_latency'] = 0.0
+            return stats
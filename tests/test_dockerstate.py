@@ -0,0 +1,174 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+from lib import Services
+from lib.DockerState import DockerState
+from model import Storage
+
+
+class NotFound(Exception):
+
+    # Like docker's errors, which carry the daemon's response
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.response = type('Response', (object,), {'status_code': 404})
+
+
+class Daemon(object):
+
+    def __init__(self):
+        self.running = {}
+        self.failure = None
+
+    def start(self, cid, port):
+        self.running[cid] = {'Id': cid,
+                             'Image': 'dockerlab:test',
+                             'Names': ['/test_' + cid],
+                             'Created': int(time.time()),
+                             'State': 'running',
+                             'Labels': {'dockerlab.port': str(port)}}
+
+    def containers(self, all=False, filters=None):
+        return list(self.running.values())
+
+    def images(self, name=None):
+        return []
+
+    def inspect_container(self, cid):
+        if self.failure is not None:
+            raise self.failure
+        if cid not in self.running:
+            raise NotFound('No such container: ' + cid)
+        return {'Id': cid,
+                'Config': {'Image': 'dockerlab:test', 'Labels': {}},
+                'Name': '/test_' + cid,
+                'Created': '2016-01-01T00:00:00Z',
+                'State': {'Status': 'running',
+                          'StartedAt': '2016-01-01T00:00:00Z'}}
+
+
+class Events(object):
+
+    def subscribe(self, callback):
+        pass
+
+    def watch(self, callback):
+        pass
+
+
+class DockerStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.saved = (Storage.STORAGE, Storage.JOURNAL_PATH,
+                      Services.DOCKER_HOSTS, dict(Services.services))
+        Storage.STORAGE = 'journal'
+        Storage.JOURNAL_PATH = self.path
+        Services.DOCKER_HOSTS = [
+            {'name': 'local', 'url': 'unix://local', 'address': '127.0.0.1'},
+            {'name': 'other', 'url': 'unix://other', 'address': '10.0.0.2'},
+        ]
+        self.daemon = Daemon()
+        Services.services.clear()
+        Services.services['client:local'] = self.daemon
+        Services.services['events'] = Events()
+        self.containers = Services.getcontainers()
+
+    def tearDown(self):
+        (Storage.STORAGE, Storage.JOURNAL_PATH,
+         Services.DOCKER_HOSTS, services) = self.saved
+        Services.services.clear()
+        Services.services.update(services)
+        shutil.rmtree(self.path)
+
+    # A registered session with a port from the allocator, running on
+    # the daemon unless running is False.
+
+    def launch(self, username, cid, running=True, host=None):
+        port = Services.getports().reserve()
+        self.containers.addcontainer(username, cid, port, 'secret',
+                                     host=host)
+        if running:
+            self.daemon.start(cid, port)
+        return port
+
+    def used(self):
+        return Services.getports().stats()['used']
+
+    def test_resync_drops_sessions_whose_container_is_gone(self):
+        self.launch('alice', 'c1')
+        self.launch('bob', 'c2', running=False)
+        state = DockerState()
+        state.resync()
+        self.assertEqual(self.containers.sessions(), [('alice', 'c1')])
+        self.assertEqual(self.used(), 1)
+        self.assertEqual(state.stats()['reconciled'], 1)
+
+    def test_resync_keeps_sessions_the_daemon_failed_to_answer_for(self):
+        self.launch('alice', 'c1')
+        state = DockerState()
+        self.daemon.running.clear()
+        self.daemon.failure = IOError('Read timed out')
+        state.resync()
+        self.assertEqual(self.containers.sessions(), [('alice', 'c1')])
+        self.assertEqual(self.used(), 1)
+        self.assertEqual(state.stats()['reconciled'], 0)
+        self.assertEqual(state.stats()['errors'], 1)
+
+    def test_session_missing_from_a_stale_listing_is_kept(self):
+        self.launch('alice', 'c1')
+        state = DockerState()
+        self.daemon.containers = lambda all=False, filters=None: []
+        state.resync()
+        self.assertEqual(self.containers.sessions(), [('alice', 'c1')])
+        self.assertEqual(self.used(), 1)
+
+    def test_destroy_event_drops_the_session_and_frees_its_port(self):
+        port = self.launch('alice', 'c1')
+        state = DockerState()
+        state.resync()
+        del self.daemon.running['c1']
+        state.onevent({'Type': 'container', 'Action': 'destroy',
+                       'Actor': {'ID': 'c1'}, 'status': 'destroy',
+                       'id': 'c1'})
+        self.assertEqual(self.containers.sessions(), [])
+        self.assertEqual(self.used(), 0)
+        self.assertEqual(Services.getports().reserve(), port + 1)
+        self.assertEqual(state.containers(), {})
+
+    def test_refresh_failure_keeps_the_cached_container(self):
+        self.launch('alice', 'c1')
+        state = DockerState()
+        state.resync()
+        self.daemon.failure = IOError('Connection reset by peer')
+        state.onevent({'Type': 'container', 'Action': 'die',
+                       'Actor': {'ID': 'c1'}, 'status': 'die',
+                       'id': 'c1'})
+        self.assertIn('c1', state.containers())
+        self.assertEqual(self.containers.sessions(), [('alice', 'c1')])
+        self.assertEqual(self.used(), 1)
+        self.assertEqual(state.stats()['errors'], 1)
+
+    def test_refresh_of_a_vanished_container_drops_it(self):
+        self.launch('alice', 'c1')
+        state = DockerState()
+        state.resync()
+        del self.daemon.running['c1']
+        state.refreshcontainer('c1')
+        self.assertNotIn('c1', state.containers())
+        self.assertEqual(self.containers.sessions(), [])
+        self.assertEqual(self.used(), 0)
+
+    def test_sessions_on_other_hosts_are_left_alone(self):
+        self.launch('alice', 'c1', running=False, host='other')
+        state = DockerState()
+        state.resync()
+        self.assertEqual(self.containers.sessions(), [('alice', 'c1')])
+        self.assertEqual(self.used(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
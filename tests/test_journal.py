@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from model.Storage import JournalStore
+
+
+class JournalStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journalpath = os.path.join(self.path, 'container.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    # A store as it is opened after a restart
+
+    def reopen(self):
+        return JournalStore('container', self.path)
+
+    def test_replays_changes_over_the_snapshot(self):
+        store = self.reopen()
+        store.create()
+        store.put('alice', {'c1': {'port': 6001}})
+        store.putfield('alice', 'c2', {'port': 6002})
+        store.putfield('bob', 'c3', {'port': 6003})
+        store.deletefield('alice', 'c1')
+        store.delete('bob')
+        store.flush()
+        store = self.reopen()
+        self.assertEqual(store.load(), {'alice': {'c2': {'port': 6002}}})
+        self.assertEqual(store.stats()['replayed'], 5)
+
+    def test_compaction_keeps_the_data_and_empties_the_journal(self):
+        store = self.reopen()
+        store.create()
+        store.put('alice', {'c1': {'port': 6001}})
+        store.put('bob', {'c2': {'port': 6002}})
+        self.assertEqual(store.compact(), 2)
+        self.assertEqual(os.path.getsize(self.journalpath), 0)
+        store.put('carol', {'c3': {'port': 6003}})
+        store.flush()
+        store = self.reopen()
+        self.assertEqual(sorted(store.load().keys()),
+                         ['alice', 'bob', 'carol'])
+        self.assertEqual(store.stats()['replayed'], 1)
+
+    def test_torn_last_line_is_dropped(self):
+        store = self.reopen()
+        store.create()
+        store.put('a', 1)
+        store.flush()
+        with open(self.journalpath, 'a') as journal:
+            journal.write('{"op": "put", "ke')
+        store = self.reopen()
+        self.assertEqual(store.load(), {'a': 1})
+
+    def test_appends_after_a_torn_line_survive_the_next_replay(self):
+        store = self.reopen()
+        store.create()
+        store.put('a', 1)
+        store.flush()
+        with open(self.journalpath, 'a') as journal:
+            journal.write('{"op": "put", "ke')
+        store = self.reopen()
+        store.put('b', 2)
+        store.put('c', 3)
+        store.flush()
+        store = self.reopen()
+        self.assertEqual(store.load(), {'a': 1, 'b': 2, 'c': 3})
+
+    def test_complete_entry_without_newline_counts_as_torn(self):
+        store = self.reopen()
+        store.create()
+        store.put('a', 1)
+        store.flush()
+        with open(self.journalpath, 'a') as journal:
+            journal.write('{"op": "put", "key": "b", "value": 2}')
+        store = self.reopen()
+        store.put('c', 3)
+        store.flush()
+        store = self.reopen()
+        self.assertEqual(store.load(), {'a': 1, 'c': 3})
+
+    def test_writes_here_do_not_change_the_version(self):
+        store = self.reopen()
+        store.create()
+        version = store.version()
+        store.put('a', 1)
+        self.assertEqual(store.version(), version)
+        other = self.reopen()
+        other.put('b', 2)
+        other.flush()
+        self.assertNotEqual(store.version(), version)
+
+
+if __name__ == '__main__':
+    unittest.main()
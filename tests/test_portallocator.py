@@ -0,0 +1,61 @@
+import unittest
+
+from lib.PortAllocator import PortAllocator, PortsExhausted
+
+
+class PortAllocatorTest(unittest.TestCase):
+
+    def test_reserves_every_port_once_then_is_exhausted(self):
+        ports = PortAllocator(6001, 6021)
+        reserved = [ports.reserve() for i in range(20)]
+        self.assertEqual(sorted(reserved), list(range(6001, 6021)))
+        self.assertRaises(PortsExhausted, ports.reserve)
+        self.assertEqual(ports.stats()['free'], 0)
+        self.assertEqual(ports.stats()['exhausted'], 1)
+
+    def test_released_port_can_be_reserved_again(self):
+        ports = PortAllocator(6001, 6011)
+        for i in range(10):
+            ports.reserve()
+        self.assertTrue(ports.release(6005))
+        self.assertEqual(ports.reserve(), 6005)
+        self.assertRaises(PortsExhausted, ports.reserve)
+
+    def test_released_port_is_not_handed_out_straight_away(self):
+        ports = PortAllocator(6001, 6101)
+        port = ports.reserve()
+        ports.release(port)
+        self.assertNotEqual(ports.reserve(), port)
+
+    def test_claimed_ports_are_skipped(self):
+        ports = PortAllocator(6001, 6005)
+        self.assertTrue(ports.claim(6001))
+        self.assertTrue(ports.claim(6003))
+        self.assertFalse(ports.claim(6003))
+        self.assertEqual(sorted([ports.reserve(), ports.reserve()]),
+                         [6002, 6004])
+        self.assertRaises(PortsExhausted, ports.reserve)
+
+    def test_ports_out_of_range_are_ignored(self):
+        ports = PortAllocator(6001, 6005)
+        self.assertFalse(ports.claim(7000))
+        self.assertFalse(ports.release(6000))
+        self.assertEqual(ports.stats()['used'], 0)
+
+    def test_double_release_is_counted_once(self):
+        ports = PortAllocator(6001, 6005)
+        port = ports.reserve()
+        self.assertTrue(ports.release(port))
+        self.assertFalse(ports.release(port))
+        self.assertEqual(ports.stats()['used'], 0)
+
+    def test_full_bytes_are_skipped_across_the_whole_range(self):
+        ports = PortAllocator(6001, 7000)
+        for port in range(6001, 6999):
+            ports.claim(port)
+        self.assertEqual(ports.reserve(), 6999)
+        self.assertRaises(PortsExhausted, ports.reserve)
+
+
+if __name__ == '__main__':
+    unittest.main()